@@ -0,0 +1,130 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+
+# Steps/s of a training step (encoder, G forward, a D and a G update per
+# stage) on random data, first eager and then with torch.compile.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Eager vs torch.compile training throughput')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--batch_size', type=int, default=0)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='untimed steps, these include compilation')
+    parser.add_argument('--mode', type=str, default='',
+                        help='compile mode, TRAIN.COMPILE.MODE by default')
+    parser.add_argument('--json', type=str, default='',
+                        help='also write the report to this file')
+    return parser.parse_args()
+
+
+def build_nets(device):
+    from model1 import encoder_resnet, G_NET, D_NET64, D_NET128, D_NET256, \
+        D_NET512, D_NET1024
+    enc = encoder_resnet(pretrained=False).to(device)
+    netG = G_NET().to(device)
+    D_nets = [D_NET64, D_NET128, D_NET256, D_NET512, D_NET1024]
+    netsD = [D_nets[i]().to(device) for i in range(cfg.TREE.BRANCH_NUM)]
+    return enc, netG, netsD
+
+
+def make_step(enc, netG, netsD, batch_size, device):
+    criterion = nn.BCEWithLogitsLoss() if cfg.GAN.D_LOGITS else nn.BCELoss()
+    optimizerG = optim.Adam(list(netG.parameters()) +
+                            list(enc.res.fc.parameters()),
+                            lr=cfg.TRAIN.GENERATOR_LR, betas=(0.5, 0.999))
+    optimizersD = [optim.Adam(netD.parameters(),
+                              lr=cfg.TRAIN.DISCRIMINATOR_LR,
+                              betas=(0.5, 0.999)) for netD in netsD]
+    unimgs = torch.randn(batch_size, 3, 224, 224, device=device)
+    imgs = [torch.randn(batch_size, 3, 64 * 2 ** i, 64 * 2 ** i,
+                        device=device).clamp_(-1, 1)
+            for i in range(len(netsD))]
+    real_labels = torch.ones(batch_size, device=device)
+    fake_labels = torch.zeros(batch_size, device=device)
+
+    def step():
+        embedding = enc(unimgs)
+        z_code = torch.randn(batch_size, cfg.GAN.Z_DIM, device=device)
+        fake_imgs, mu, _ = netG(z_code, embedding)
+        c_code = mu.detach() if mu is not None else None
+        for i, netD in enumerate(netsD):
+            netD.zero_grad()
+            real_logits = netD(imgs[i], c_code)
+            fake_logits = netD(fake_imgs[i].detach(), c_code)
+            errD = criterion(real_logits[0], real_labels) + \
+                criterion(fake_logits[0], fake_labels)
+            errD.backward()
+            optimizersD[i].step()
+        optimizerG.zero_grad()
+        errG = 0
+        for i, netD in enumerate(netsD):
+            outputs = netD(fake_imgs[i], mu)
+            errG = errG + criterion(outputs[0], real_labels)
+        errG.backward()
+        optimizerG.step()
+
+    return step
+
+
+def steps_per_sec(step, steps, warmup):
+    for _ in range(warmup):
+        step()
+    if cfg.CUDA:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if cfg.CUDA:
+        torch.cuda.synchronize()
+    return steps / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = args.gpu_id != '-1'
+    device = torch.device('cuda:%s' % args.gpu_id if cfg.CUDA else 'cpu')
+    if cfg.CUDA:
+        torch.cuda.set_device(device)
+        torch.backends.cudnn.benchmark = True
+    batch_size = args.batch_size or cfg.TRAIN.BATCH_SIZE
+    mode = args.mode or cfg.TRAIN.COMPILE.MODE
+
+    enc, netG, netsD = build_nets(device)
+    step = make_step(enc, netG, netsD, batch_size, device)
+    report = [{'compile': 'eager', 'batch_size': batch_size,
+               'steps_per_sec': steps_per_sec(step, args.steps, args.warmup)}]
+    for net in [enc, netG] + netsD:
+        net.compile(mode=mode)
+    report.append({'compile': mode, 'batch_size': batch_size,
+                   'steps_per_sec': steps_per_sec(step, args.steps,
+                                                  args.warmup)})
+    for row in report:
+        print('%-16s %8.2f steps/s  %8.1f img/s' %
+              (row['compile'], row['steps_per_sec'],
+               row['steps_per_sec'] * batch_size))
+    print('speedup %.2fx' %
+          (report[1]['steps_per_sec'] / report[0]['steps_per_sec']))
+    if args.json != '':
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
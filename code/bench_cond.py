@@ -0,0 +1,110 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+from miscc.bench import SavedTensorMeter, reset_peak_memory, peak_memory
+
+# Time and memory of each joint conv (condition code + h_code) forward and
+# backward, with the repeated condition map and with GAN.FACTORIZED_COND.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the factorized condition joint convs')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--batch_size', type=int, default=0)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--json', type=str, default='',
+                        help='also write the report to this file')
+    return parser.parse_args()
+
+
+def joint_convs(device):
+    # (name, JointConv, h_code channels, grid size) for every stage
+    from model1 import G_NET, D_NET64, D_NET128, D_NET256, D_NET512, \
+        D_NET1024
+    netG = G_NET().to(device)
+    convs = []
+    for i in range(1, cfg.TREE.BRANCH_NUM):
+        h_net = getattr(netG, 'h_net%d' % (i + 1))
+        convs.append(('G%d' % i, h_net.jointConv, h_net.gf_dim,
+                      64 * 2 ** (i - 1)))
+    if cfg.GAN.B_CONDITION:
+        D_nets = [D_NET64, D_NET128, D_NET256, D_NET512, D_NET1024]
+        for i in range(cfg.TREE.BRANCH_NUM):
+            netD = D_nets[i]().to(device)
+            convs.append(('D%d' % i, netD.jointConv, cfg.GAN.DF_DIM * 8, 4))
+    return convs
+
+
+def run(conv, h_code, c_code):
+    out = conv(h_code, c_code)
+    out.sum().backward()
+    return out
+
+
+def measure(conv, h_code, c_code, iters):
+    run(conv, h_code, c_code)
+    reset_peak_memory()
+    with SavedTensorMeter([conv]) as meter:
+        out = conv(h_code, c_code)
+    out.sum().backward()
+    peak = peak_memory()
+    if cfg.CUDA:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        run(conv, h_code, c_code)
+    if cfg.CUDA:
+        torch.cuda.synchronize()
+    ms = 1000.0 * (time.perf_counter() - start) / iters
+    return out.detach(), meter.bytes, peak, ms
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = args.gpu_id != '-1'
+    device = torch.device('cuda:%s' % args.gpu_id if cfg.CUDA else 'cpu')
+    if cfg.CUDA:
+        torch.cuda.set_device(device)
+    batch_size = args.batch_size or cfg.TRAIN.BATCH_SIZE
+
+    report = []
+    for name, conv, channels, size in joint_convs(device):
+        h_code = torch.randn(batch_size, channels, size, size, device=device,
+                             requires_grad=True)
+        c_code = torch.randn(batch_size, conv.cond_dim, device=device,
+                             requires_grad=True)
+        outs = []
+        for factorized in (False, True):
+            conv.factorized = factorized
+            out, saved, peak, ms = measure(conv, h_code, c_code, args.iters)
+            outs.append(out)
+            row = {'stage': name, 'factorized': factorized,
+                   'batch_size': batch_size, 'ms': ms,
+                   'saved_mb': saved / 2.0 ** 20,
+                   'peak_mb': None if peak is None else peak / 2.0 ** 20}
+            report.append(row)
+            print('%-3s %-10s %8.2f ms  saved %8.1f MB  peak %s' %
+                  (name, 'factorized' if factorized else 'repeat', ms,
+                   row['saved_mb'], 'n/a' if peak is None
+                   else '%.1f MB' % row['peak_mb']))
+        print('%-3s max abs diff %.3g' %
+              (name, (outs[0] - outs[1]).abs().max().item()))
+    if args.json != '':
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
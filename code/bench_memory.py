@@ -0,0 +1,99 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+from miscc.bench import SavedTensorMeter, reset_peak_memory, peak_memory
+
+# Memory of a generator step (G forward, every D on the fakes and
+# backward) with activation checkpointing off, per stage and everywhere.
+# Saved activations are counted on any device, the peak only on CUDA.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Memory report for activation checkpointing')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--batch_size', type=int, default=0)
+    parser.add_argument('--upblock', type=str, default='',
+                        help='override GAN.UPBLOCK (nearest or subpixel)')
+    parser.add_argument('--json', type=str, default='',
+                        help='also write the report to this file')
+    return parser.parse_args()
+
+
+def build_nets(device):
+    from model1 import G_NET, D_NET64, D_NET128, D_NET256, D_NET512, \
+        D_NET1024
+    netG = G_NET().to(device)
+    D_nets = [D_NET64, D_NET128, D_NET256, D_NET512, D_NET1024]
+    netsD = [D_nets[i]().to(device) for i in range(cfg.TREE.BRANCH_NUM)]
+    return netG, netsD
+
+
+def set_checkpoint(netG, netsD, g_stages, d_stages):
+    netG.set_checkpoint(g_stages)
+    for i, netD in enumerate(netsD):
+        netD.use_checkpoint = i in d_stages
+
+
+def measure(netG, netsD, batch_size, device):
+    netG.zero_grad()
+    for netD in netsD:
+        netD.zero_grad()
+    z_code = torch.randn(batch_size, cfg.GAN.Z_DIM, device=device)
+    embedding = torch.randn(batch_size, cfg.TEXT.DIMENSION,
+                            device=device).tanh()
+    reset_peak_memory()
+    with SavedTensorMeter([netG] + netsD) as meter:
+        fake_imgs, mu, _ = netG(z_code, embedding)
+        loss = 0
+        for i, netD in enumerate(netsD):
+            loss = loss + netD(fake_imgs[i], mu)[0].mean()
+    loss.backward()
+    return meter.bytes, peak_memory()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = args.gpu_id != '-1'
+    if args.upblock != '':
+        cfg.GAN.UPBLOCK = args.upblock
+    device = torch.device('cuda:%s' % args.gpu_id if cfg.CUDA else 'cpu')
+    if cfg.CUDA:
+        torch.cuda.set_device(device)
+    batch_size = args.batch_size or cfg.TRAIN.BATCH_SIZE
+
+    netG, netsD = build_nets(device)
+    stages = list(range(cfg.TREE.BRANCH_NUM))
+    cases = [('none', [], [])]
+    cases += [('G%d' % i, [i], []) for i in stages]
+    cases += [('D%d' % i, [], [i]) for i in stages]
+    cases += [('all', stages, stages)]
+
+    report = []
+    for name, g_stages, d_stages in cases:
+        set_checkpoint(netG, netsD, g_stages, d_stages)
+        saved, peak = measure(netG, netsD, batch_size, device)
+        report.append({'checkpoint': name, 'batch_size': batch_size,
+                       'upblock': cfg.GAN.UPBLOCK,
+                       'saved_mb': saved / 2.0 ** 20,
+                       'peak_mb': None if peak is None else peak / 2.0 ** 20})
+        print('%-6s saved activations %9.1f MB  peak %s' %
+              (name, saved / 2.0 ** 20,
+               'n/a' if peak is None else '%.1f MB' % (peak / 2.0 ** 20)))
+    if args.json != '':
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
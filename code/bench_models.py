@@ -0,0 +1,181 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+from miscc.bench import allocation_stats
+
+# Forward and backward time, allocations and peak memory of the model1
+# building blocks on random inputs, across batch sizes, GF_DIM / DF_DIM and
+# thread counts. Nothing is downloaded: encoder_resnet and INCEPTION_V3
+# keep their random initialization. Modules run in training mode, except
+# at batch size 1 where BatchNorm1d needs eval mode, and INCEPTION_V3,
+# which always runs in eval mode as it does for the inception score.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark model1 modules')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--modules', type=str, default='',
+                        help='comma separated, all of them by default')
+    parser.add_argument('--batch_sizes', type=str, default='1,8')
+    parser.add_argument('--gf_dims', type=str, default='',
+                        help='GF_DIM values, the config one by default')
+    parser.add_argument('--df_dims', type=str, default='',
+                        help='DF_DIM values, the config one by default')
+    parser.add_argument('--threads', type=str, default='',
+                        help='CPU thread counts, the current one by default')
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--json', type=str, default='')
+    return parser.parse_args()
+
+
+def ints(text, default):
+    return [int(v) for v in text.split(',')] if text else [default]
+
+
+def build_case(name):
+    # the module and a function of the batch size making its inputs
+    import model1
+    gf = cfg.GAN.GF_DIM
+    if name == 'CA_NET':
+        return model1.CA_NET(), \
+            lambda b: [torch.randn(b, cfg.TEXT.DIMENSION)]
+    if name == 'INIT_STAGE_G':
+        return model1.INIT_STAGE_G(gf * 16), \
+            lambda b: [torch.randn(b, cfg.GAN.Z_DIM),
+                       torch.randn(b, cfg.GAN.EMBEDDING_DIM)]
+    if name == 'NEXT_STAGE_G':
+        c_dim = cfg.GAN.EMBEDDING_DIM if cfg.GAN.B_CONDITION \
+            else cfg.GAN.Z_DIM
+        return model1.NEXT_STAGE_G(gf), \
+            lambda b: [torch.randn(b, gf, 64, 64), torch.randn(b, c_dim)]
+    if name == 'GET_IMAGE_G':
+        return model1.GET_IMAGE_G(gf), \
+            lambda b: [torch.randn(b, gf, 64, 64)]
+    if name == 'G_NET':
+        return model1.G_NET(), \
+            lambda b: [torch.randn(b, cfg.GAN.Z_DIM),
+                       torch.randn(b, cfg.TEXT.DIMENSION).tanh()]
+    if name.startswith('D_NET'):
+        size = int(name[len('D_NET'):])
+        return getattr(model1, name)(), \
+            lambda b: [torch.randn(b, 3, size, size).tanh(),
+                       torch.randn(b, cfg.GAN.EMBEDDING_DIM)]
+    if name == 'encoder_resnet':
+        return model1.encoder_resnet(pretrained=False), \
+            lambda b: [torch.randn(b, 3, 224, 224)]
+    if name == 'INCEPTION_V3':
+        size = 64 * 2 ** (cfg.TREE.BRANCH_NUM - 1)
+        return model1.INCEPTION_V3(pretrained=False), \
+            lambda b: [torch.randn(b, 3, size, size).tanh()]
+    raise ValueError('unknown module %s' % name)
+
+
+# each module and the cfg.GAN width it is built from
+CASES = [('CA_NET', None), ('INIT_STAGE_G', 'GF_DIM'),
+         ('NEXT_STAGE_G', 'GF_DIM'), ('GET_IMAGE_G', 'GF_DIM'),
+         ('G_NET', 'GF_DIM'), ('D_NET64', 'DF_DIM'),
+         ('D_NET128', 'DF_DIM'), ('D_NET256', 'DF_DIM'),
+         ('encoder_resnet', None), ('INCEPTION_V3', None)]
+
+
+def flat_sum(out):
+    # a scalar from the tensors in a (nested) list / tuple output
+    if torch.is_tensor(out):
+        return out.float().mean()
+    return sum(flat_sum(o) for o in out if o is not None)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_it(fn, iters, device):
+    fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return 1000.0 * (time.perf_counter() - start) / iters
+
+
+def measure(net, inputs, iters, device):
+    # the inputs take gradients too, so modules without trainable
+    # parameters (INCEPTION_V3) still have a backward pass
+    inputs = [x.to(device).requires_grad_() for x in inputs]
+
+    def forward():
+        return flat_sum(net(*inputs))
+
+    def step():
+        forward().backward()
+    forward_ms = time_it(forward, iters, device)
+    step_ms = time_it(step, iters, device)
+    allocs, alloc_bytes, peak = allocation_stats(
+        step, 1 if device.type == 'cuda' else 0)
+    return {'forward_ms': forward_ms,
+            'backward_ms': max(step_ms - forward_ms, 0.0),
+            'allocs': allocs, 'alloc_mb': alloc_bytes / 2.0 ** 20,
+            'peak_mb': peak / 2.0 ** 20}
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = args.gpu_id != '-1'
+    device = torch.device('cuda:%s' % args.gpu_id if cfg.CUDA else 'cpu')
+    if cfg.CUDA:
+        torch.cuda.set_device(device)
+    names = args.modules.split(',') if args.modules else \
+        [name for name, _ in CASES]
+    widths = dict(CASES)
+    dims = {'GF_DIM': ints(args.gf_dims, cfg.GAN.GF_DIM),
+            'DF_DIM': ints(args.df_dims, cfg.GAN.DF_DIM), None: [None]}
+    default_dims = (cfg.GAN.GF_DIM, cfg.GAN.DF_DIM)
+
+    report = []
+    for threads in ints(args.threads, torch.get_num_threads()):
+        torch.set_num_threads(threads)
+        for name in names:
+            width = widths[name]
+            for dim in dims[width]:
+                cfg.GAN.GF_DIM, cfg.GAN.DF_DIM = default_dims
+                if width is not None:
+                    cfg.GAN[width] = dim
+                net, make_inputs = build_case(name)
+                net = net.to(device)
+                for batch_size in ints(args.batch_sizes, 1):
+                    # INCEPTION_V3 is only ever run in eval mode, where its
+                    # aux_logits head returns no InceptionOutputs tuple
+                    net.train(batch_size > 1 and name != 'INCEPTION_V3')
+                    row = {'module': name, 'batch_size': batch_size,
+                           'threads': threads, 'gf_dim': cfg.GAN.GF_DIM,
+                           'df_dim': cfg.GAN.DF_DIM, 'device': device.type}
+                    row.update(measure(net, make_inputs(batch_size),
+                                       args.iters, device))
+                    report.append(row)
+                    print('%-14s bs %3d thr %2d %s %8.2f ms fwd %8.2f ms '
+                          'bwd %7d allocs %9.1f MB peak' %
+                          (name, batch_size, threads,
+                           '' if width is None else '%s %3d' % (width, dim),
+                           row['forward_ms'], row['backward_ms'],
+                           row['allocs'], row['peak_mb']))
+                del net
+    if args.json != '':
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,181 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+from miscc.bench import reset_peak_memory, peak_memory
+
+# Throughput of condGANTrainer.train for a fixed number of steps: steps/s,
+# images/s, the fraction of time waiting on the DataLoader and the peak
+# RSS. The per-step rows of the StepTimer CSV after --warmup steps are
+# aggregated. With --baseline the results are compared with a saved run
+# and the script exits with status 1 on a regression above --threshold.
+
+# metrics compared with the baseline: (higher is better, relative change)
+METRICS = {'steps_per_sec': (True, True), 'images_per_sec': (True, True),
+           'data_wait_frac': (False, False), 'peak_rss_mb': (False, True)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Trainer throughput')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/synthetic_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--data_dir', type=str, default='')
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='first steps left out of the results')
+    parser.add_argument('--batch_size', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output_dir', type=str, default='',
+                        help='kept if given, a removed temp dir otherwise')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='compare with this saved run')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='allowed relative slowdown / memory growth, '
+                             'absolute for fractions')
+    parser.add_argument('--save_baseline', type=str, default='')
+    parser.add_argument('--json', type=str, default='')
+    return parser.parse_args()
+
+
+def aggregate(csv_path, warmup, batch_size):
+    steps = elapsed = wait = 0.0
+    phases = {}
+    with open(csv_path) as f:
+        # one row per step; count is the global step, which does not start
+        # at 0 when resuming from TRAIN.NET_G
+        for i, row in enumerate(csv.DictReader(f)):
+            if i < warmup:
+                continue
+            n = int(row['steps'])
+            # images_per_sec = steps * batch_size / elapsed of the row
+            seconds = n * batch_size / max(float(row['images_per_sec']),
+                                           1e-12)
+            steps += n
+            elapsed += seconds
+            wait += float(row['data_wait_frac']) * seconds
+            for key, value in row.items():
+                if key.endswith('_ms') and value != '':
+                    phases[key] = phases.get(key, 0.0) + float(value) * n
+    assert steps > 0, 'no steps after the warmup in %s' % csv_path
+    results = {'steps': int(steps),
+               'steps_per_sec': steps / elapsed,
+               'images_per_sec': steps * batch_size / elapsed,
+               'data_wait_frac': wait / elapsed}
+    for key, total in phases.items():
+        results[key] = total / steps
+    return results
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name in sorted(METRICS):
+        if name not in baseline:
+            continue
+        higher, relative = METRICS[name]
+        old, new = baseline[name], results[name]
+        change = (new - old) / max(abs(old), 1e-12) if relative \
+            else new - old
+        worse = -change if higher else change
+        flag = worse > threshold
+        if flag:
+            regressions.append(name)
+        print('%-16s %12.4f -> %12.4f  %+8.2f%s  %s' %
+              (name, old, new, 100 * change if relative else change,
+               '%' if relative else '', 'REGRESSION' if flag else 'ok'))
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    if args.gpu_id != '-1':
+        cfg.GPU_ID = args.gpu_id
+    else:
+        cfg.CUDA = False
+    if args.data_dir != '':
+        cfg.DATA_DIR = args.data_dir
+    if args.batch_size > 0:
+        cfg.TRAIN.BATCH_SIZE = args.batch_size
+    if args.workers >= 0:
+        cfg.WORKERS = args.workers
+    cfg.TRAIN.FLAG = True
+    cfg.TRAIN.MAX_STEPS = args.warmup + args.steps
+    cfg.TRAIN.SNAPSHOT_INTERVAL = cfg.TRAIN.MAX_STEPS + 1
+    # one timing row per step, without extra synchronization
+    cfg.TRAIN.TIMING.FLAG = True
+    cfg.TRAIN.TIMING.INTERVAL = 1
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if cfg.CUDA:
+        torch.cuda.manual_seed_all(args.seed)
+
+    from main1 import make_dataset, make_dataloader
+    from trainer1_2 import condGANTrainer
+    dataset, imsize = make_dataset('train')
+    dataloader = make_dataloader(dataset, True)
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='bench_trainer_')
+    algo = condGANTrainer(output_dir, dataloader, imsize)
+
+    reset_peak_memory()
+    start_t = time.time()
+    algo.train()
+    wall = time.time() - start_t
+
+    results = aggregate(os.path.join(output_dir, 'Log', 'timing.csv'),
+                        args.warmup, algo.batch_size)
+    results['wall_sec'] = wall
+    results['peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_SELF)
+    results['peak_rss_workers_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    peak = peak_memory() if cfg.CUDA else None
+    results['peak_cuda_mb'] = None if peak is None else peak / 2.0 ** 20
+    config = {'cfg': args.cfg_file, 'batch_size': algo.batch_size,
+              'workers': int(cfg.WORKERS), 'steps': args.steps,
+              'warmup': args.warmup, 'device': 'cuda' if cfg.CUDA else 'cpu',
+              'torch': torch.__version__}
+    if not args.output_dir:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    print('%d steps: %.3f steps/s  %.1f img/s  data wait %.1f%%  '
+          'peak RSS %.0f MB' %
+          (results['steps'], results['steps_per_sec'],
+           results['images_per_sec'], 100 * results['data_wait_frac'],
+           results['peak_rss_mb']))
+    report = {'config': config, 'results': results}
+    for path in (args.json, args.save_baseline):
+        if path != '':
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline != '':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key, value in baseline['config'].items():
+            if config.get(key) != value:
+                print('warning: baseline %s is %s, this run %s' %
+                      (key, value, config.get(key)))
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            sys.exit('regression in %s' % ', '.join(regressions))
@@ -23,6 +23,7 @@ import os.path
 import six
 import string
 import sys
+import time
 import torch
 import ntpath
 import glob
@@ -40,7 +41,10 @@ def is_image_file(filename):
 
 
 def get_imgs(img_path, imsize, bbox=None,
-             transform=None, normalize=None):
+             transform=None, normalize=None, num_levels=None):
+    # num_levels < BRANCH_NUM skips the higher resolutions of the pyramid
+    if num_levels is None:
+        num_levels = cfg.TREE.BRANCH_NUM
     img = Image.open(img_path).convert('RGB')
     width, height = img.size
     if bbox is not None:
@@ -57,7 +61,7 @@ def get_imgs(img_path, imsize, bbox=None,
         img = transform(img)
 
     ret = []
-    for i in range(cfg.TREE.BRANCH_NUM):
+    for i in range(num_levels):
         if i < (cfg.TREE.BRANCH_NUM - 1):
             re_img = transforms.Resize(imsize[i])(img)
         else:
@@ -200,6 +204,9 @@ class TextDataset(data.Dataset):
         for i in range(cfg.TREE.BRANCH_NUM):
             self.imsize.append(base_size)
             base_size = base_size * 2
+        # pyramid levels returned for imgs and wrong_imgs; lowered by the
+        # trainer while higher stages are inactive
+        self.num_levels = cfg.TREE.BRANCH_NUM
 
         self.data = []
         self.data_dir = data_dir
@@ -301,7 +308,8 @@ class TextDataset(data.Dataset):
         #embeddings = self.embeddings[index, :, :]
         img_name = '%s/images/%s.jpg' % (data_dir, key)
         imgs = get_imgs(img_name, self.imsize,
-                        bbox, self.transform, normalize=self.norm)
+                        bbox, self.transform, normalize=self.norm,
+                        num_levels=self.num_levels)
         sz = [224, 224, 224]
         unimgs = get_imgs(img_name, sz,
                         bbox, self.transform, normalize=self.norm2)
@@ -317,7 +325,8 @@ class TextDataset(data.Dataset):
         wrong_img_name = '%s/images/%s.jpg' % \
             (data_dir, wrong_key)
         wrong_imgs = get_imgs(wrong_img_name, self.imsize,
-                              wrong_bbox, self.transform, normalize=self.norm)
+                              wrong_bbox, self.transform, normalize=self.norm,
+                              num_levels=self.num_levels)
 
         #embedding_ix = random.randint(0, embeddings.shape[0] - 1)
         #embedding = embeddings[embedding_ix, :]
@@ -371,6 +380,9 @@ class TextDatasetf(data.Dataset):
         for i in range(cfg.TREE.BRANCH_NUM):
             self.imsize.append(base_size)
             base_size = base_size * 2
+        # pyramid levels returned for imgs and wrong_imgs; lowered by the
+        # trainer while higher stages are inactive
+        self.num_levels = cfg.TREE.BRANCH_NUM
 
         self.data = []
         self.data_dir = data_dir
@@ -468,7 +480,8 @@ class TextDatasetf(data.Dataset):
         #img_name = '%s/images/%s.jpg' % (data_dir, key)
         bbox = None
         imgs = get_imgs(img_name, self.imsize,
-                        bbox, self.transform, normalize=self.norm)
+                        bbox, self.transform, normalize=self.norm,
+                        num_levels=self.num_levels)
         sz = [224, 224, 224]
         unimgs = get_imgs(img_name, sz,
                         bbox, self.transform, normalize=self.norm2)
@@ -479,7 +492,8 @@ class TextDatasetf(data.Dataset):
         wrong_img_name = self.images[wrong_ix]
         wrong_bbox= None
         wrong_imgs = get_imgs(wrong_img_name, self.imsize,
-                              wrong_bbox, self.transform, normalize=self.norm)
+                              wrong_bbox, self.transform, normalize=self.norm,
+                              num_levels=self.num_levels)
 
         #embedding_ix = random.randint(0, embeddings.shape[0] - 1)
         #embedding = embeddings[embedding_ix, :]
@@ -512,3 +526,84 @@ class TextDatasetf(data.Dataset):
     def __len__(self):
         return len(self.images)
 
+
+
+class SyntheticDataset(data.Dataset):
+    """Procedural images in the tuples of TextDataset, without any files.
+
+    Item i is a smooth random image seeded by SYNTHETIC.SEED and i, so
+    every epoch and worker sees the same data. The training tuple is
+    (unimgs, imgs, wrong_imgs, 0, key) and the test tuple (imgs, 0, key),
+    with the pyramid sizes and normalizations of get_imgs. Each item
+    spins for SYNTHETIC.COST_MS to stand in for decoding.
+    """
+    def __init__(self, split='train', base_size=64, transform=None,
+                 target_transform=None):
+        self.split = split
+        self.imsize = []
+        for i in range(cfg.TREE.BRANCH_NUM):
+            self.imsize.append(base_size)
+            base_size = base_size * 2
+        self.num_levels = cfg.TREE.BRANCH_NUM
+        self.seed = cfg.SYNTHETIC.SEED + (0 if split == 'train' else 1)
+        self.cost_s = cfg.SYNTHETIC.COST_MS / 1000.0
+        self.filenames = ['synthetic/%s_%06d' % (split, i)
+                          for i in range(cfg.SYNTHETIC.NUM_ITEMS)]
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+        if cfg.TRAIN.FLAG:
+            self.iterator = self.prepair_training_pairs
+        else:
+            self.iterator = self.prepair_test_pairs
+
+    def make_image(self, index):
+        # 3 x imsize x imsize in [0, 1]: bilinear upsampling of 8 x 8 noise
+        gen = torch.Generator().manual_seed(self.seed * 1000003 + index)
+        low = torch.rand(1, 3, 8, 8, generator=gen)
+        img = torch.nn.functional.interpolate(
+            low, size=(self.imsize[-1], self.imsize[-1]), mode='bilinear',
+            align_corners=False)
+        return img[0]
+
+    def resize(self, img, size):
+        if img.size(-1) == size:
+            return img
+        return torch.nn.functional.interpolate(
+            img[None], size=(size, size), mode='bilinear',
+            align_corners=False)[0]
+
+    def get_imgs(self, img, sizes, num_levels=None):
+        # like get_imgs: every level but the last one is resized
+        if num_levels is None:
+            num_levels = cfg.TREE.BRANCH_NUM
+        return [self.resize(img, sizes[i])
+                if i < cfg.TREE.BRANCH_NUM - 1 else img
+                for i in range(num_levels)]
+
+    def spin(self):
+        end = time.perf_counter() + self.cost_s
+        while time.perf_counter() < end:
+            pass
+
+    def prepair_training_pairs(self, index):
+        self.spin()
+        img = self.make_image(index)
+        imgs = self.get_imgs(img * 2 - 1, self.imsize, self.num_levels)
+        sz = [224, 224, 224]
+        unimgs = self.get_imgs((img - self.mean) / self.std, sz)
+        wrong_ix = random.randint(0, len(self.filenames) - 1)
+        wrong_imgs = self.get_imgs(self.make_image(wrong_ix) * 2 - 1,
+                                   self.imsize, self.num_levels)
+        return unimgs, imgs, wrong_imgs, 0, self.filenames[index]
+
+    def prepair_test_pairs(self, index):
+        self.spin()
+        imgs = self.get_imgs(self.make_image(index) * 2 - 1, self.imsize)
+        return imgs, 0, self.filenames[index]
+
+    def __getitem__(self, index):
+        return self.iterator(index)
+
+    def __len__(self):
+        return len(self.filenames)
@@ -0,0 +1,172 @@
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+
+# Encoder codes of a dataset split on disk: codes.f16 is a float16
+# num x dim memmap, ids.json maps rows to dataset keys and meta.json holds
+# the shape. search() runs exact nearest-neighbour queries in chunks;
+# after build_ivf() an inverted-file index (k-means lists) can be probed
+# instead of scanning every row.
+
+
+class EmbeddingStore(object):
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.num, self.dim = meta['num'], meta['dim']
+        self.codes = np.memmap(os.path.join(path, 'codes.f16'),
+                               dtype=np.float16, mode=mode,
+                               shape=(self.num, self.dim))
+        with open(os.path.join(path, 'ids.json')) as f:
+            self.ids = json.load(f)
+        self.row_of = dict((key, row) for row, key in enumerate(self.ids))
+        self.ivf = None
+        ivf_path = os.path.join(path, 'ivf.npz')
+        if os.path.isfile(ivf_path):
+            self.ivf = dict(np.load(ivf_path))
+
+    @classmethod
+    def create(cls, path, num, dim, ids):
+        assert len(ids) == num
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.memmap(os.path.join(path, 'codes.f16'), dtype=np.float16,
+                  mode='w+', shape=(num, dim)).flush()
+        with open(os.path.join(path, 'ids.json'), 'w') as f:
+            json.dump([str(key) for key in ids], f)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'num': num, 'dim': dim, 'dtype': 'float16'}, f)
+        return cls(path, mode='r+')
+
+    def write(self, start, codes):
+        self.codes[start:start + len(codes)] = codes
+
+    def flush(self):
+        self.codes.flush()
+
+    def get(self, keys):
+        # codes of dataset keys, as float32
+        return np.asarray(self.codes[[self.row_of[str(key)] for key in keys]],
+                          dtype=np.float32)
+
+    def interpolate(self, key_a, key_b, steps=8):
+        # steps codes on the line from key_a to key_b, for G
+        a, b = self.get([key_a, key_b])
+        alpha = np.linspace(0, 1, steps, dtype=np.float32)[:, None]
+        return (1 - alpha) * a + alpha * b
+
+    @staticmethod
+    def _scores(queries, codes, metric):
+        # larger is nearer
+        if metric == 'cosine':
+            codes = codes / np.maximum(
+                np.linalg.norm(codes, axis=1, keepdims=True), 1e-12)
+            return queries.dot(codes.T)
+        return 2 * queries.dot(codes.T) - np.sum(codes * codes, 1)[None]
+
+    def _prepare(self, queries, metric):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if metric == 'cosine':
+            queries = queries / np.maximum(
+                np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        return queries
+
+    def _finish(self, queries, scores, rows, metric):
+        order = np.argsort(-scores, 1)
+        scores = np.take_along_axis(scores, order, 1)
+        rows = np.take_along_axis(rows, order, 1)
+        if metric == 'l2':
+            # back to squared distances
+            scores = np.sum(queries * queries, 1)[:, None] - scores
+        return scores, rows
+
+    def search(self, queries, k=10, metric='cosine', nprobe=0,
+               chunk=65536):
+        """k nearest rows of each query: (scores, rows), nearest first.
+
+        Scores are cosine similarities, or squared distances for 'l2'.
+        With nprobe > 0 and an IVF index only the rows of the nprobe
+        lists nearest to a query are scored. Map rows to keys with ids.
+        """
+        assert metric in ('cosine', 'l2')
+        queries = self._prepare(queries, metric)
+        if nprobe > 0 and self.ivf is not None:
+            return self._search_ivf(queries, k, metric, nprobe)
+        num_q = queries.shape[0]
+        best_s = np.empty((num_q, 0), dtype=np.float32)
+        best_i = np.empty((num_q, 0), dtype=np.int64)
+        for start in range(0, self.num, chunk):
+            codes = np.asarray(self.codes[start:start + chunk],
+                               dtype=np.float32)
+            scores = self._scores(queries, codes, metric)
+            rows = np.broadcast_to(
+                np.arange(start, start + codes.shape[0]), scores.shape)
+            best_s, best_i = self._merge(best_s, best_i, scores, rows, k)
+        return self._finish(queries, best_s, best_i, metric)
+
+    @staticmethod
+    def _merge(best_s, best_i, scores, rows, k):
+        scores = np.concatenate([best_s, scores], 1)
+        rows = np.concatenate([best_i, rows], 1)
+        if scores.shape[1] > k:
+            part = np.argpartition(-scores, k - 1, 1)[:, :k]
+            scores = np.take_along_axis(scores, part, 1)
+            rows = np.take_along_axis(rows, part, 1)
+        return scores, rows
+
+    def build_ivf(self, num_lists=256, iters=20, sample=100000, seed=0,
+                  chunk=65536):
+        """k-means lists over the codes, saved to ivf.npz next to them."""
+        rng = np.random.RandomState(seed)
+        picked = np.sort(rng.choice(self.num, min(sample, self.num),
+                                    replace=False))
+        train = np.asarray(self.codes[picked], dtype=np.float32)
+        num_lists = min(num_lists, len(train))
+        centroids = train[rng.choice(len(train), num_lists, replace=False)]
+        for _ in range(iters):
+            assign = self._nearest(train, centroids)
+            for j in range(num_lists):
+                members = train[assign == j]
+                if len(members):
+                    centroids[j] = members.mean(0)
+        assign = np.concatenate([
+            self._nearest(np.asarray(self.codes[s:s + chunk],
+                                     dtype=np.float32), centroids)
+            for s in range(0, self.num, chunk)])
+        order = np.argsort(assign, kind='stable')
+        offsets = np.searchsorted(assign[order], np.arange(num_lists + 1))
+        self.ivf = {'centroids': centroids, 'rows': order.astype(np.int64),
+                    'offsets': offsets.astype(np.int64)}
+        np.savez(os.path.join(self.path, 'ivf.npz'), **self.ivf)
+
+    @staticmethod
+    def _nearest(x, centroids):
+        dist = np.sum(centroids * centroids, 1)[None] - 2 * x.dot(centroids.T)
+        return np.argmin(dist, 1)
+
+    def _search_ivf(self, queries, k, metric, nprobe):
+        ivf = self.ivf
+        probe = np.argsort(
+            -self._scores(queries, ivf['centroids'], metric), 1)[:, :nprobe]
+        num_q = queries.shape[0]
+        out_s = np.full((num_q, k), -np.inf, dtype=np.float32)
+        out_i = np.full((num_q, k), -1, dtype=np.int64)
+        for q in range(num_q):
+            rows = np.concatenate([
+                ivf['rows'][ivf['offsets'][j]:ivf['offsets'][j + 1]]
+                for j in probe[q]])
+            if len(rows) == 0:
+                continue
+            rows = np.sort(rows)
+            codes = np.asarray(self.codes[rows], dtype=np.float32)
+            scores = self._scores(queries[q:q + 1], codes, metric)
+            s, i = self._merge(out_s[q:q + 1, :0], out_i[q:q + 1, :0],
+                               scores, rows[None], k)
+            out_s[q, :s.shape[1]] = s[0]
+            out_i[q, :i.shape[1]] = i[0]
+        return self._finish(queries, out_s, out_i, metric)
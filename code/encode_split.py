@@ -0,0 +1,81 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+from embedding_store import EmbeddingStore
+from eval_fid import make_dataset, real_batches, encoder_input
+
+# Encode a dataset split with encoder_resnet into an EmbeddingStore, and
+# optionally build its IVF index. Rows follow the dataset order.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Encode a dataset split')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--net_e', type=str, required=True,
+                        help='encG_*.pth')
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--out', type=str, required=True,
+                        help='directory of the store')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--ivf_lists', type=int, default=0,
+                        help='also build an IVF index with this many lists')
+    return parser.parse_args()
+
+
+def dataset_ids(dataset):
+    for name in ('filenames', 'images'):
+        ids = getattr(dataset, name, None)
+        if ids is not None and len(ids) == len(dataset):
+            return list(ids)
+    return list(range(len(dataset)))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = args.gpu_id != '-1'
+    device = torch.device('cuda:%s' % args.gpu_id if cfg.CUDA else 'cpu')
+    if cfg.CUDA:
+        torch.cuda.set_device(device)
+        torch.backends.cudnn.benchmark = True
+
+    from model1 import encoder_resnet
+    enc = encoder_resnet(pretrained=False)
+    enc.load_state_dict(
+        torch.load(args.net_e, map_location='cpu')['state_dict'])
+    enc = enc.to(device).eval()
+
+    dataset, _ = make_dataset(args.split)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=False,
+        num_workers=int(cfg.WORKERS))
+    store = EmbeddingStore.create(args.out, len(dataset), cfg.TEXT.DIMENSION,
+                                  dataset_ids(dataset))
+    start_t = time.time()
+    row = 0
+    with torch.no_grad():
+        for unimgs, imgs in real_batches(loader):
+            if unimgs is None:
+                unimgs = encoder_input(imgs.to(device))
+            codes = enc(unimgs.to(device)).half().cpu().numpy()
+            store.write(row, codes)
+            row += len(codes)
+    store.flush()
+    print('Encoded %d images in %.1f sec to %s' %
+          (row, time.time() - start_t, args.out))
+    if args.ivf_lists > 0:
+        store.build_ivf(args.ivf_lists)
+        print('Built IVF index with %d lists' % args.ivf_lists)
@@ -0,0 +1,176 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+from miscc.metrics import FeatureStats, frechet_distance
+from miscc.utils import mkdir_p
+
+# FID of a generator against the real images of a dataset split, on the
+# INCEPTION_V3 pool features. The real-image mean and covariance are cached
+# in --cache_dir under a key of the dataset, split and transform, so later
+# checkpoints only pay for the fake images. --mode recon scores the
+# reconstructions of the split (encoder_resnet + G_NET), --mode prior
+# samples from N(0, I) as eval_is.py does.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='FID of G')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--net_g', type=str, default='',
+                        help='netG_*.pth; only the real stats if empty')
+    parser.add_argument('--net_e', type=str, default='',
+                        help='encG_*.pth, next to netG_*.pth by default')
+    parser.add_argument('--mode', type=str, default='recon',
+                        choices=['recon', 'prior'])
+    parser.add_argument('--split', type=str, default='test')
+    parser.add_argument('--num_samples', type=int, default=0,
+                        help='prior samples, TEST.SAMPLE_NUM by default')
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache_dir', type=str, default='',
+                        help='<DATA_DIR>/fid_stats by default')
+    return parser.parse_args()
+
+
+def make_dataset(split):
+    # the training transform without its random crop and flip
+    imsize = cfg.TREE.BASE_SIZE * (2 ** (cfg.TREE.BRANCH_NUM - 1))
+    transform = transforms.Compose([
+        transforms.Resize(int(imsize * 76 / 64)),
+        transforms.CenterCrop(imsize)])
+    if cfg.DATASET_NAME == 'synthetic':
+        from datasets1_2 import SyntheticDataset
+        return SyntheticDataset(split, base_size=cfg.TREE.BASE_SIZE,
+                                transform=transform), transform
+    if cfg.DATASET_NAME == 'birds':
+        from datasets1_2 import TextDataset as Dataset
+    else:
+        from datasets1_2 import TextDatasetf as Dataset
+    dataset = Dataset(cfg.DATA_DIR, split, base_size=cfg.TREE.BASE_SIZE,
+                      transform=transform)
+    return dataset, transform
+
+
+def real_batches(loader):
+    # (encoder input, last-level image in [-1, 1]) of each batch
+    for data in loader:
+        if len(data) == 5:
+            # training tuple: unimgs, imgs, wrong_imgs, embedding, key
+            yield data[0][0], data[1][-1]
+        else:
+            # test tuple: imgs, embeddings, key
+            yield None, data[0][-1]
+
+
+def encoder_input(imgs):
+    # like ureal_imgs: 224 x 224 with the ImageNet statistics
+    x = F.interpolate(imgs * 0.5 + 0.5, size=(224, 224), mode='bilinear',
+                      align_corners=False)
+    mean = x.new_tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = x.new_tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    return (x - mean) / std
+
+
+def cache_path(cache_dir, split, dataset, transform):
+    fields = {'dataset': cfg.DATASET_NAME,
+              'data_dir': os.path.abspath(cfg.DATA_DIR),
+              'split': split, 'num_images': len(dataset),
+              'transform': repr(transform)}
+    if cfg.DATASET_NAME == 'synthetic':
+        # the images are made from the seed, not read from DATA_DIR
+        fields['synthetic_seed'] = cfg.SYNTHETIC.SEED
+    key = json.dumps(fields, sort_keys=True)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, 'fid_%s_%s_%s.npz' %
+                        (cfg.DATASET_NAME, split, digest))
+
+
+def real_stats(inception_model, loader, path, device):
+    if os.path.isfile(path):
+        data = np.load(path)
+        print('Load real stats from', path)
+        return data['mu'], data['sigma']
+    stats = FeatureStats()
+    with torch.no_grad():
+        for _, imgs in real_batches(loader):
+            stats.update(inception_model.features(imgs.to(device)).cpu())
+    mkdir_p(os.path.dirname(path))
+    stats.save(path)
+    print('Saved real stats of %d images to %s' % (stats.count, path))
+    return stats.mean_covariance()
+
+
+def fake_stats(args, inception_model, loader, device):
+    stats = FeatureStats()
+    last = cfg.TREE.BRANCH_NUM - 1
+    with torch.no_grad():
+        if args.mode == 'prior':
+            from eval_is import load_sampler, sample_batch
+            netG = load_sampler(args.net_g).to(device)
+            num_samples = args.num_samples or cfg.TEST.SAMPLE_NUM
+            num_batches = (num_samples + args.batch_size - 1) // \
+                args.batch_size
+            for batch in range(num_batches):
+                fake_imgs = sample_batch(netG, batch, args.batch_size,
+                                         num_samples, args.seed, device)
+                stats.update(inception_model.features(fake_imgs).cpu())
+        else:
+            from serve import load_models
+            enc, netG = load_models(args.net_g, args.net_e, device)
+            torch.manual_seed(args.seed)
+            for unimgs, imgs in real_batches(loader):
+                if unimgs is None:
+                    unimgs = encoder_input(imgs.to(device))
+                embedding = enc(unimgs.to(device))
+                z_code = torch.randn(embedding.size(0), cfg.GAN.Z_DIM,
+                                     device=device)
+                fake_imgs, _, _ = netG(z_code, embedding, out_stages=[last])
+                stats.update(inception_model.features(fake_imgs[last]).cpu())
+    return stats.mean_covariance()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = args.gpu_id != '-1'
+    device = torch.device('cuda:%s' % args.gpu_id if cfg.CUDA else 'cpu')
+    if cfg.CUDA:
+        torch.cuda.set_device(device)
+        torch.backends.cudnn.benchmark = True
+
+    from model1 import INCEPTION_V3
+    inception_model = INCEPTION_V3().to(device).eval()
+    dataset, transform = make_dataset(args.split)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=False,
+        num_workers=int(cfg.WORKERS))
+    cache_dir = args.cache_dir or os.path.join(cfg.DATA_DIR, 'fid_stats')
+    mu_real, sigma_real = real_stats(
+        inception_model, loader,
+        cache_path(cache_dir, args.split, dataset, transform), device)
+    if args.net_g == '':
+        sys.exit(0)
+
+    start_t = time.time()
+    mu_fake, sigma_fake = fake_stats(args, inception_model, loader, device)
+    print('FID (%s, %s) %.4f  [%.1f sec]' %
+          (args.mode, args.split,
+           frechet_distance(mu_real, sigma_real, mu_fake, sigma_fake),
+           time.time() - start_t))
@@ -0,0 +1,146 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file, cfg_from_dict
+from miscc.metrics import InceptionScoreStats
+
+# Inception score and NLPP of TEST.SAMPLE_NUM samples from a generator.
+# z and the condition code c are drawn from N(0, I), the prior CA_NET is
+# trained towards, and G runs without CA_NET (G_NET1). Batch b is drawn
+# from seed + b, so the samples do not depend on how the run is sharded:
+#   python eval_is.py --net_g netG_2000.pth --shard 0 --num_shards 4 ...
+#   python eval_is.py --merge is_shard*.npz
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Inception score of G')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--net_g', type=str, default='',
+                        help='netG_*.pth or an export_inference.py artifact')
+    parser.add_argument('--num_samples', type=int, default=0,
+                        help='TEST.SAMPLE_NUM by default')
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--splits', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shard', type=int, default=0)
+    parser.add_argument('--num_shards', type=int, default=1)
+    parser.add_argument('--out', type=str, default='',
+                        help='save the shard statistics to this .npz')
+    parser.add_argument('--merge', nargs='+', default=[],
+                        help='add up shard .npz files and report')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the streaming statistics with '
+                             'compute_inception_score and exit')
+    return parser.parse_args()
+
+
+def load_sampler(path):
+    # G_NET weights without CA_NET, which the prior sampling skips
+    from model1 import G_NET1
+    from inference import fold_bn, load_training_state
+    state = torch.load(path, map_location='cpu')
+    if 'version' in state:
+        cfg_from_dict(state['cfg'])
+        netG = fold_bn(G_NET1())
+        state_dict = dict((k, v.float() if v.is_floating_point() else v)
+                          for k, v in state['state_dict'].items())
+    else:
+        netG = G_NET1()
+        state_dict = load_training_state(path)
+    netG.load_state_dict(dict((k, v) for k, v in state_dict.items()
+                              if not k.startswith('ca_net.')))
+    return netG.eval()
+
+
+def sample_batch(netG, batch, batch_size, num_samples, seed, device):
+    size = min(batch_size, num_samples - batch * batch_size)
+    generator = torch.Generator().manual_seed(seed + batch)
+    z_code = torch.randn(size, cfg.GAN.Z_DIM, generator=generator)
+    c_code = None
+    if cfg.GAN.B_CONDITION:
+        c_code = torch.randn(size, cfg.GAN.EMBEDDING_DIM,
+                             generator=generator).to(device)
+    last = cfg.TREE.BRANCH_NUM - 1
+    return netG(z_code.to(device), c_code, out_stages=[last])[last]
+
+
+def check_streaming(num_samples=1003, num_splits=10, batch_size=64):
+    # N % S != 0 and batches that straddle the split boundaries
+    import numpy as np
+    from trainer1_2 import compute_inception_score, \
+        negative_log_posterior_probability
+    rng = np.random.RandomState(0)
+    predictions = rng.dirichlet(np.ones(1000), num_samples)
+    stats = InceptionScoreStats(num_samples, num_splits)
+    for start in range(0, num_samples, batch_size):
+        stats.update(predictions[start:start + batch_size], start)
+    expected = compute_inception_score(predictions, num_splits) + \
+        negative_log_posterior_probability(predictions, num_splits)
+    actual = stats.scores()
+    for name, e, a in zip(['IS mean', 'IS std', 'NLPP mean', 'NLPP std'],
+                          expected, actual):
+        print('%-9s in-memory %.6f streaming %.6f' % (name, e, a))
+    if not np.allclose(expected, actual, rtol=1e-6, atol=1e-9):
+        sys.exit('streaming statistics differ from compute_inception_score')
+
+
+def report(stats):
+    is_mean, is_std, nlpp_mean, nlpp_std = stats.scores()
+    print('%d samples, %d splits' % (stats.count.sum(), stats.num_splits))
+    print('IS   %.4f +- %.4f' % (is_mean, is_std))
+    print('NLPP %.4f +- %.4f' % (nlpp_mean, nlpp_std))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.check:
+        check_streaming()
+        sys.exit(0)
+    if args.merge:
+        stats = InceptionScoreStats.load(args.merge[0])
+        for path in args.merge[1:]:
+            stats.merge(InceptionScoreStats.load(path))
+        report(stats)
+        sys.exit(0)
+
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = args.gpu_id != '-1'
+    device = torch.device('cuda:%s' % args.gpu_id if cfg.CUDA else 'cpu')
+    if cfg.CUDA:
+        torch.cuda.set_device(device)
+        torch.backends.cudnn.benchmark = True
+    num_samples = args.num_samples or cfg.TEST.SAMPLE_NUM
+
+    from model1 import INCEPTION_V3
+    netG = load_sampler(args.net_g).to(device)
+    inception_model = INCEPTION_V3().to(device).eval()
+
+    stats = InceptionScoreStats(num_samples, args.splits)
+    num_batches = (num_samples + args.batch_size - 1) // args.batch_size
+    start_t = time.time()
+    with torch.no_grad():
+        for batch in range(args.shard, num_batches, args.num_shards):
+            fake_imgs = sample_batch(netG, batch, args.batch_size,
+                                     num_samples, args.seed, device)
+            pred = inception_model(fake_imgs)
+            stats.update(pred.cpu().numpy(), batch * args.batch_size)
+    elapsed = time.time() - start_t
+    print('shard %d/%d: %d samples in %.1f sec (%.1f img/s)' %
+          (args.shard, args.num_shards, stats.count.sum(), elapsed,
+           stats.count.sum() / max(elapsed, 1e-6)))
+    if args.out != '':
+        stats.save(args.out)
+    if args.num_shards == 1:
+        report(stats)
@@ -0,0 +1,72 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import torch
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+from inference import load_training_state, export_generator, \
+    load_generator, build_generator
+
+# Export netG_*.pth to a BatchNorm-folded inference artifact and check
+# that the loaded artifact matches the training model.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Export a generator for inference')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--net_g', type=str, required=True,
+                        help='training checkpoint, e.g. netG_2000.pth')
+    parser.add_argument('--arch', type=str, default='G_NET',
+                        choices=['G_NET', 'G_NET1'])
+    parser.add_argument('--out', type=str, default='',
+                        help='artifact path, <net_g>_infer.pth by default')
+    parser.add_argument('--half', action='store_true',
+                        help='store the weights in float16')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--tol', type=float, default=1e-4)
+    return parser.parse_args()
+
+
+def generate(netG, arch, z_code, embedding):
+    # same CA_NET noise for both models
+    torch.manual_seed(0)
+    with torch.no_grad():
+        if arch == 'G_NET':
+            return netG(z_code, embedding)[0]
+        return netG(z_code)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    out_path = args.out or '%s_infer.pth' % os.path.splitext(args.net_g)[0]
+
+    netG = build_generator(args.arch)
+    netG.load_state_dict(load_training_state(args.net_g))
+    netG.eval()
+
+    z_code = torch.randn(args.batch_size, cfg.GAN.Z_DIM)
+    embedding = torch.randn(args.batch_size, cfg.TEXT.DIMENSION).tanh()
+    expected = generate(netG, args.arch, z_code, embedding)
+
+    torch.save(export_generator(netG, args.arch, args.half), out_path)
+    print('Saved %s (%.1f MB, was %.1f MB)' %
+          (out_path, os.path.getsize(out_path) / 2.0 ** 20,
+           os.path.getsize(args.net_g) / 2.0 ** 20))
+
+    tol = max(args.tol, 1e-2) if args.half else args.tol
+    actual = generate(load_generator(out_path), args.arch, z_code, embedding)
+    for i, (a, b) in enumerate(zip(expected, actual)):
+        diff = (a - b).abs().max().item()
+        print('stage %d max abs diff %.3g' % (i, diff))
+        if diff > tol:
+            sys.exit('stage %d differs by more than %g' % (i, tol))
@@ -0,0 +1,132 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+
+# Export encoder_resnet + G_NET as one ONNX graph: image, z_code and the
+# CA_NET noise eps in, the images of --stages out, with a dynamic batch
+# size. The exported graph is checked against PyTorch with onnxruntime at
+# two batch sizes and both are timed on the CPU.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export to ONNX')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--net_g', type=str, required=True)
+    parser.add_argument('--net_e', type=str, default='',
+                        help='encG_*.pth, next to netG_*.pth by default')
+    parser.add_argument('--stages', type=str, default='',
+                        help='comma separated output stages, the last one '
+                             'by default')
+    parser.add_argument('--out', type=str, default='',
+                        help='<net_g>.onnx by default')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--batch_sizes', type=str, default='1,8')
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--tol', type=float, default=1e-3)
+    parser.add_argument('--json', type=str, default='')
+    return parser.parse_args()
+
+
+class Reconstruction(nn.Module):
+    # the graph that is exported: no cfg lookups, no lists, no sampling
+    def __init__(self, enc, netG, out_stages):
+        super(Reconstruction, self).__init__()
+        self.enc = enc
+        self.netG = netG
+        self.out_stages = list(out_stages)
+
+    def forward(self, image, z_code, eps):
+        embedding = self.enc(image)
+        fake_imgs, _, _ = self.netG(z_code, embedding,
+                                    out_stages=self.out_stages, eps=eps)
+        return tuple(fake_imgs[i] for i in self.out_stages)
+
+
+def make_inputs(batch_size, seed=0):
+    gen = torch.Generator().manual_seed(seed)
+    return (torch.randn(batch_size, 3, 224, 224, generator=gen),
+            torch.randn(batch_size, cfg.GAN.Z_DIM, generator=gen),
+            torch.randn(batch_size, cfg.GAN.EMBEDDING_DIM, generator=gen))
+
+
+def export(model, path, opset):
+    input_names = ['image', 'z_code', 'eps']
+    output_names = ['image%d' % (64 * 2 ** i) for i in model.out_stages]
+    dynamic_axes = dict((name, {0: 'batch'})
+                        for name in input_names + output_names)
+    with torch.no_grad():
+        torch.onnx.export(model, make_inputs(2), path,
+                          input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset,
+                          do_constant_folding=True)
+    return input_names
+
+
+def time_it(fn, iters):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return 1000.0 * (time.perf_counter() - start) / iters
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = False
+    import onnxruntime as ort
+    from serve import load_models
+    from inference import fold_bn
+
+    enc, netG = load_models(args.net_g, args.net_e, torch.device('cpu'))
+    if args.stages == '':
+        out_stages = [netG.branch_num - 1]
+    else:
+        out_stages = [int(s) for s in args.stages.split(',')]
+    model = Reconstruction(fold_bn(enc), fold_bn(netG), out_stages).eval()
+    out_path = args.out or '%s.onnx' % os.path.splitext(args.net_g)[0]
+    input_names = export(model, out_path, args.opset)
+    print('Saved %s (%.1f MB)' %
+          (out_path, os.path.getsize(out_path) / 2.0 ** 20))
+
+    session = ort.InferenceSession(out_path,
+                                   providers=['CPUExecutionProvider'])
+    # inputs the graph does not use (eps without B_CONDITION) are dropped
+    used = set(i.name for i in session.get_inputs())
+    report = {}
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        inputs = make_inputs(batch_size, seed=batch_size)
+        feed = dict((name, x.numpy()) for name, x in zip(input_names, inputs)
+                    if name in used)
+        with torch.no_grad():
+            expected = model(*inputs)
+        actual = session.run(None, feed)
+        diff = max((e - torch.from_numpy(a)).abs().max().item()
+                   for e, a in zip(expected, actual))
+        if diff > args.tol:
+            sys.exit('batch %d: ONNX differs from PyTorch by %.3g' %
+                     (batch_size, diff))
+        with torch.no_grad():
+            torch_ms = time_it(lambda: model(*inputs), args.iters)
+        ort_ms = time_it(lambda: session.run(None, feed), args.iters)
+        report[batch_size] = {'max_abs_diff': diff, 'torch_ms': torch_ms,
+                              'onnxruntime_ms': ort_ms}
+        print('batch %3d  max abs diff %.3g  torch %8.1f ms  '
+              'onnxruntime %8.1f ms' % (batch_size, diff, torch_ms, ort_ms))
+    if args.json != '':
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,53 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import torch
+import torch.utils.model_zoo as model_zoo
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from model1 import PRETRAINED_URLS
+
+# Fill a WEIGHTS_DIR with the pretrained ImageNet weights, on a machine
+# with network access (or from already downloaded files with --src). The
+# files are re-saved in the zip format of torch.save, which torch.load can
+# memory-map; copy the directory to the air-gapped machines.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fetch pretrained weights')
+    parser.add_argument('--out', type=str, required=True,
+                        help='the WEIGHTS_DIR to fill')
+    parser.add_argument('--src', type=str, default='',
+                        help='read the files from here instead of the hub')
+    parser.add_argument('--names', type=str, default='',
+                        help='comma separated, all of %s by default' %
+                             ', '.join(sorted(PRETRAINED_URLS)))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    names = args.names.split(',') if args.names else sorted(PRETRAINED_URLS)
+    for name in names:
+        filename = os.path.basename(PRETRAINED_URLS[name])
+        if args.src != '':
+            state_dict = torch.load(os.path.join(args.src, filename),
+                                    map_location='cpu')
+        else:
+            state_dict = model_zoo.load_url(PRETRAINED_URLS[name],
+                                            map_location='cpu')
+        path = os.path.join(args.out, filename)
+        torch.save(state_dict, path)
+        # check that it loads the way model1 will load it
+        torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        print('%-14s %s (%.1f MB)' %
+              (name, path, os.path.getsize(path) / 2.0 ** 20))
+    print('Set WEIGHTS_DIR: %s in the config' % os.path.abspath(args.out))
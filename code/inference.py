@@ -0,0 +1,99 @@
+from __future__ import print_function
+
+import torch
+import torch.nn as nn
+
+from miscc.config import cfg, cfg_from_dict
+
+# Compact generator artifacts for inference: BatchNorm folded into the
+# preceding conv / linear layer, no discriminators, encoder or Inception.
+
+ARTIFACT_VERSION = 1
+
+
+def _fold(layer, bn):
+    # layer(x) followed by bn in eval mode as a single affine layer
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shape = [-1] + [1] * (layer.weight.dim() - 1)
+    weight = layer.weight * scale.view(shape)
+    bias = -bn.running_mean * scale + bn.bias
+    if layer.bias is not None:
+        bias = bias + layer.bias * scale
+    if isinstance(layer, nn.Linear):
+        folded = nn.Linear(layer.in_features, layer.out_features, bias=True)
+    else:
+        folded = nn.Conv2d(layer.in_channels, layer.out_channels,
+                           layer.kernel_size, layer.stride, layer.padding,
+                           layer.dilation, layer.groups, bias=True)
+    folded.weight.data.copy_(weight)
+    folded.bias.data.copy_(bias)
+    return folded.to(layer.weight)
+
+
+def fold_bn(net):
+    """Fold every Conv2d + BatchNorm2d and Linear + BatchNorm1d pair.
+
+    The pairs are consecutive entries of an nn.Sequential, as in upBlock,
+    Block3x3_relu, ResBlock, the joint convs and INIT_STAGE_G.fc. The
+    BatchNorm is replaced by nn.Identity. Works on an untrained model too,
+    to rebuild the structure of a folded state_dict.
+    """
+    pairs = ((nn.Conv2d, nn.BatchNorm2d), (nn.Linear, nn.BatchNorm1d))
+    with torch.no_grad():
+        for module in list(net.modules()):
+            if not isinstance(module, nn.Sequential):
+                continue
+            for i in range(len(module) - 1):
+                for layer_type, bn_type in pairs:
+                    if isinstance(module[i], layer_type) and \
+                            isinstance(module[i + 1], bn_type):
+                        module[i] = _fold(module[i], module[i + 1])
+                        module[i + 1] = nn.Identity()
+    return net
+
+
+def _model_cfg():
+    # the options the generator is built from
+    return {'GAN': dict(cfg.GAN),
+            'TREE': {'BRANCH_NUM': cfg.TREE.BRANCH_NUM},
+            'TEXT': {'DIMENSION': cfg.TEXT.DIMENSION}}
+
+
+def build_generator(arch):
+    from model1 import G_NET, G_NET1
+    return {'G_NET': G_NET, 'G_NET1': G_NET1}[arch]()
+
+
+def load_training_state(path):
+    # netG_*.pth from save_model, or a bare (DataParallel) state_dict
+    state_dict = torch.load(path, map_location='cpu')
+    if 'state_dict' in state_dict:
+        state_dict = state_dict['state_dict']
+    return dict((k[len('module.'):] if k.startswith('module.') else k, v)
+                for k, v in state_dict.items())
+
+
+def export_generator(netG, arch, half=False):
+    """Artifact dict of a trained generator, BatchNorm folded."""
+    netG = fold_bn(netG.eval())
+    state_dict = netG.state_dict()
+    if half:
+        state_dict = dict((k, v.half() if v.is_floating_point() else v)
+                          for k, v in state_dict.items())
+    return {'version': ARTIFACT_VERSION, 'arch': arch,
+            'cfg': _model_cfg(), 'state_dict': state_dict}
+
+
+def load_generator(path, device='cpu', dtype=torch.float32):
+    """Generator in eval mode from an artifact written by export_generator.
+
+    The model options saved with the artifact are merged into cfg first.
+    """
+    artifact = torch.load(path, map_location='cpu')
+    assert artifact['version'] == ARTIFACT_VERSION, artifact['version']
+    cfg_from_dict(artifact['cfg'])
+    netG = fold_bn(build_generator(artifact['arch']))
+    state_dict = dict((k, v.float() if v.is_floating_point() else v)
+                      for k, v in artifact['state_dict'].items())
+    netG.load_state_dict(state_dict)
+    return netG.to(device=device, dtype=dtype).eval()
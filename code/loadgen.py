@@ -0,0 +1,89 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import threading
+import time
+from urllib.request import Request, urlopen
+
+# Closed-loop load for serve.py: --concurrency clients each send requests
+# back to back for --duration seconds, then the throughput, the client
+# latency percentiles and the server /metrics are printed.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load generator')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--image', type=str, default='',
+                        help='image to send, a random 256x256 one if empty')
+    parser.add_argument('--stage', type=int, default=-1,
+                        help='stage to request, the server default if < 0')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--json', type=str, default='',
+                        help='also write the report to this file')
+    return parser.parse_args()
+
+
+def load_image(path):
+    if path != '':
+        with open(path, 'rb') as f:
+            return f.read()
+    import numpy as np
+    from PIL import Image
+    pixels = np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def client(url, body, stop_at, latencies, errors, lock):
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        try:
+            req = Request(url, data=body,
+                          headers={'Content-Type': 'application/octet-stream'})
+            urlopen(req).read()
+        except Exception:
+            with lock:
+                errors[0] += 1
+            continue
+        with lock:
+            latencies.append(1000.0 * (time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    body = load_image(args.image)
+    url = args.url + '/reconstruct'
+    if args.stage >= 0:
+        url += '?stage=%d' % args.stage
+
+    latencies, errors, lock = [], [0], threading.Lock()
+    start = time.perf_counter()
+    stop_at = start + args.duration
+    threads = [threading.Thread(target=client,
+                                args=(url, body, stop_at, latencies, errors,
+                                      lock))
+               for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    report = {'concurrency': args.concurrency,
+              'requests': len(latencies), 'errors': errors[0],
+              'requests_per_sec': len(latencies) / elapsed}
+    for p in (50, 95, 99):
+        if latencies:
+            report['p%d_ms' % p] = \
+                latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+    report['server'] = json.loads(urlopen(args.url + '/metrics').read())
+    print(json.dumps(report, indent=2))
+    if args.json != '':
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import torch
+import torch.distributed as dist
 import torchvision.transforms as transforms
 
 import argparse
@@ -65,10 +66,74 @@ def parse_args():
     parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
     parser.add_argument('--data_dir', dest='data_dir', type=str, default='')
     parser.add_argument('--manualSeed', type=int, help='manual seed')
+    parser.add_argument('--profile', action='store_true',
+                        help='capture a torch.profiler trace into Log/')
+    parser.add_argument('--profile_start', type=int, default=-1,
+                        help='first profiled step')
+    parser.add_argument('--profile_steps', type=int, default=-1,
+                        help='number of profiled steps')
+    parser.add_argument('--profile_stack', action='store_true',
+                        help='record python stacks in the trace')
+    parser.add_argument('--dist', action='store_true',
+                        help='DistributedDataParallel training (use torchrun)')
+    parser.add_argument('--dist_backend', type=str, default='')
     args = parser.parse_args()
     return args
 
 
+def make_dataset(split_dir):
+    # the dataset of cfg.DATA_DIR / cfg.DATASET_NAME, with the training
+    # augmentation; also returns the size of the largest image
+    imsize = cfg.TREE.BASE_SIZE * (2 ** (cfg.TREE.BRANCH_NUM-1))
+    image_transform = transforms.Compose([
+        transforms.Resize(int(imsize * 76 / 64)),
+        transforms.RandomCrop(imsize),
+        transforms.RandomHorizontalFlip()])
+    dataset = None
+    if cfg.DATASET_NAME == 'synthetic':
+        from datasets1_2 import SyntheticDataset
+        dataset = SyntheticDataset(split_dir, base_size=cfg.TREE.BASE_SIZE,
+                                   transform=image_transform)
+    elif cfg.DATA_DIR.find('lsun') != -1:
+        from datasets import LSUNClass
+        dataset = LSUNClass('%s/%s_%s_lmdb' %
+                            (cfg.DATA_DIR, cfg.DATASET_NAME, split_dir),
+                            base_size=cfg.TREE.BASE_SIZE, transform=image_transform)
+    elif cfg.DATA_DIR.find('imagenet') != -1:
+        from datasets import ImageFolder
+        dataset = ImageFolder(cfg.DATA_DIR, split_dir='train',
+                              custom_classes=CLASS_DIC[cfg.DATASET_NAME],
+                              base_size=cfg.TREE.BASE_SIZE,
+                              transform=image_transform)
+    elif cfg.GAN.B_CONDITION:  # text to image task
+        if cfg.DATASET_NAME == 'birds':
+            from datasets1_2 import TextDataset
+            dataset = TextDataset(cfg.DATA_DIR, split_dir,
+                              base_size=cfg.TREE.BASE_SIZE,
+                              transform=image_transform)
+        elif cfg.DATASET_NAME == 'flowers':
+            from datasets1_2 import TextDatasetf
+            dataset = TextDatasetf(cfg.DATA_DIR, split_dir,
+                              base_size=cfg.TREE.BASE_SIZE,
+                              transform=image_transform)
+
+    assert dataset
+    return dataset, imsize
+
+
+def make_dataloader(dataset, bshuffle):
+    num_gpu = len(cfg.GPU_ID.split(','))
+    sampler = None
+    if cfg.DIST.FLAG:
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            dataset, shuffle=bshuffle, drop_last=True)
+        bshuffle = False
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=cfg.TRAIN.BATCH_SIZE * num_gpu,
+        drop_last=True, shuffle=bshuffle, sampler=sampler,
+        num_workers=int(cfg.WORKERS))
+
+
 if __name__ == "__main__":
     args = parse_args()
     if args.cfg_file is not None:
@@ -81,22 +146,59 @@ if __name__ == "__main__":
 
     if args.data_dir != '':
         cfg.DATA_DIR = args.data_dir
-    print('Using config:')
-    pprint.pprint(cfg)
+
+    if args.dist or int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        cfg.DIST.FLAG = True
+    if cfg.DIST.FLAG:
+        cfg.DIST.RANK = int(os.environ.get('RANK', 0))
+        cfg.DIST.WORLD_SIZE = int(os.environ.get('WORLD_SIZE', 1))
+        cfg.DIST.LOCAL_RANK = int(os.environ.get('LOCAL_RANK', 0))
+        if args.dist_backend != '':
+            cfg.DIST.BACKEND = args.dist_backend
+        if not cfg.CUDA:
+            cfg.DIST.BACKEND = 'gloo'
+        else:
+            # one process per GPU
+            cfg.GPU_ID = str(cfg.DIST.LOCAL_RANK)
+            torch.cuda.set_device(cfg.DIST.LOCAL_RANK)
+        dist.init_process_group(backend=cfg.DIST.BACKEND,
+                                init_method='env://',
+                                rank=cfg.DIST.RANK,
+                                world_size=cfg.DIST.WORLD_SIZE)
+
+    if args.profile:
+        cfg.PROFILE.FLAG = True
+    if args.profile_start >= 0:
+        cfg.PROFILE.START = args.profile_start
+    if args.profile_steps > 0:
+        cfg.PROFILE.STEPS = args.profile_steps
+    if args.profile_stack:
+        cfg.PROFILE.STACK = True
+    if cfg.DIST.RANK == 0:
+        print('Using config:')
+        pprint.pprint(cfg)
 
     if not cfg.TRAIN.FLAG:
         args.manualSeed = 100
     elif args.manualSeed is None:
         args.manualSeed = random.randint(1, 10000)
-    random.seed(args.manualSeed)
-    torch.manual_seed(args.manualSeed)
+    # Each rank draws different noise and augmentations; DDP broadcasts
+    # the initial weights of rank 0
+    seed = args.manualSeed + cfg.DIST.RANK
+    random.seed(seed)
+    torch.manual_seed(seed)
     if cfg.CUDA:
-        torch.cuda.manual_seed_all(args.manualSeed)
+        torch.cuda.manual_seed_all(seed)
 
     now = datetime.datetime.now(dateutil.tz.tzlocal())
     timestamp = now.strftime('%Y_%m_%d_%H_%M_%S')
     output_dir = '../output/%s_%s_%s' % \
         (cfg.DATASET_NAME, cfg.CONFIG_NAME, timestamp)
+    if cfg.DIST.FLAG:
+        # all ranks share the output dir of rank 0
+        shared = [output_dir]
+        dist.broadcast_object_list(shared, src=0)
+        output_dir = shared[0]
     #output_dir = '../output/flowers_3stages_2020_05_20_15_53_10'
 
     split_dir, bshuffle = 'train', True
@@ -105,40 +207,8 @@ if __name__ == "__main__":
             bshuffle = False
             split_dir = 'test'
 
-    # Get data loader
-    imsize = cfg.TREE.BASE_SIZE * (2 ** (cfg.TREE.BRANCH_NUM-1))
-    image_transform = transforms.Compose([
-        transforms.Resize(int(imsize * 76 / 64)),
-        transforms.RandomCrop(imsize),
-        transforms.RandomHorizontalFlip()])
-    if cfg.DATA_DIR.find('lsun') != -1:
-        from datasets import LSUNClass
-        dataset = LSUNClass('%s/%s_%s_lmdb' %
-                            (cfg.DATA_DIR, cfg.DATASET_NAME, split_dir),
-                            base_size=cfg.TREE.BASE_SIZE, transform=image_transform)
-    elif cfg.DATA_DIR.find('imagenet') != -1:
-        from datasets import ImageFolder
-        dataset = ImageFolder(cfg.DATA_DIR, split_dir='train',
-                              custom_classes=CLASS_DIC[cfg.DATASET_NAME],
-                              base_size=cfg.TREE.BASE_SIZE,
-                              transform=image_transform)
-    elif cfg.GAN.B_CONDITION:  # text to image task
-        if cfg.DATASET_NAME == 'birds':
-            from datasets1_2 import TextDataset
-            dataset = TextDataset(cfg.DATA_DIR, split_dir,
-                              base_size=cfg.TREE.BASE_SIZE,
-                              transform=image_transform)
-        elif cfg.DATASET_NAME == 'flowers':
-            from datasets1_2 import TextDatasetf
-            dataset = TextDatasetf(cfg.DATA_DIR, split_dir,
-                              base_size=cfg.TREE.BASE_SIZE,
-                              transform=image_transform)
-            
-    assert dataset
-    num_gpu = len(cfg.GPU_ID.split(','))
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=cfg.TRAIN.BATCH_SIZE * num_gpu,
-        drop_last=True, shuffle=bshuffle, num_workers=int(cfg.WORKERS))
+    dataset, imsize = make_dataset(split_dir)
+    dataloader = make_dataloader(dataset, bshuffle)
 
     # Define models and go to train/evaluate
     if not cfg.GAN.B_CONDITION:
@@ -154,6 +224,8 @@ if __name__ == "__main__":
         algo.evaluate(split_dir)
     end_t = time.time()
     print('Total time for training:', end_t - start_t)
+    if cfg.DIST.FLAG:
+        dist.destroy_process_group()
     ''' Running time comparison for 10epoch with batch_size 24 on birds dataset
         T(1gpu) = 1.383 T(2gpus)
             - gpu 2: 2426.228544 -> 4min/epoch
@@ -0,0 +1,90 @@
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+
+import torch
+from torch.autograd.graph import saved_tensors_hooks
+from torch.profiler import ProfilerActivity, profile
+
+
+class SavedTensorMeter(object):
+    """Count the bytes autograd keeps for backward inside the block.
+
+    Each storage is counted once and the parameters of `nets` are left
+    out, so the total is the activation memory of the forward pass on
+    any device.
+    """
+    def __init__(self, nets=()):
+        self.bytes = 0
+        self.seen = set()
+        for net in nets:
+            for p in net.parameters():
+                self.seen.add(p.untyped_storage().data_ptr())
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.seen:
+            self.seen.add(storage.data_ptr())
+            self.bytes += storage.nbytes()
+        return tensor
+
+    def __enter__(self):
+        self.hooks = saved_tensors_hooks(self.pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+        return False
+
+
+def reset_peak_memory():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory():
+    # peak allocated device memory since reset_peak_memory(), or None on CPU
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated()
+    return None
+
+
+def allocation_stats(fn, device_type=0):
+    """Run fn() under the profiler: (allocations, bytes allocated, peak).
+
+    The peak is the most memory held at once above the level at the first
+    allocation. device_type is that of the profiler trace, 0 for the CPU
+    and 1 for CUDA.
+    """
+    with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA]
+                 if device_type else [ProfilerActivity.CPU],
+                 profile_memory=True) as prof:
+        fn()
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        prof.export_chrome_trace(path)
+        with open(path) as f:
+            trace = json.load(f)
+    finally:
+        os.remove(path)
+    events = [e for e in trace['traceEvents']
+              if e.get('name') == '[memory]' and
+              e['args'].get('Device Type', 0) == device_type]
+    count, total, peak, base = 0, 0, 0, None
+    for event in sorted(events, key=lambda e: e['ts']):
+        nbytes = event['args']['Bytes']
+        level = event['args']['Total Allocated']
+        if base is None:
+            base = level - nbytes
+        if nbytes > 0:
+            count += 1
+            total += nbytes
+        peak = max(peak, level - base)
+    return count, total, peak
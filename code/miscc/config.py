@@ -9,7 +9,7 @@ from easydict import EasyDict as edict
 __C = edict()
 cfg = __C
 
-# Dataset name: flowers, birds
+# Dataset name: flowers, birds, synthetic
 __C.DATASET_NAME = 'birds'
 __C.EMBEDDING_TYPE = 'cnn-rnn'
 __C.CONFIG_NAME = ''
@@ -19,6 +19,24 @@ __C.GPU_ID = '0'
 __C.CUDA = True
 
 __C.WORKERS = 6
+# Pretrained ImageNet weights (ResNet-50, Inception-v3) saved by
+# fetch_weights.py; empty uses the torch hub cache and downloads on a miss
+__C.WEIGHTS_DIR = ''
+
+# DATASET_NAME 'synthetic': procedural images in memory, no DATA_DIR
+__C.SYNTHETIC = edict()
+__C.SYNTHETIC.NUM_ITEMS = 2048
+__C.SYNTHETIC.COST_MS = 0.0  # busy time per item, standing in for decoding
+__C.SYNTHETIC.SEED = 0
+
+# Multi-process DistributedDataParallel training, launched with torchrun.
+# RANK, WORLD_SIZE and LOCAL_RANK are filled in from the environment.
+__C.DIST = edict()
+__C.DIST.FLAG = False
+__C.DIST.BACKEND = 'nccl'  # gloo is used when running on CPU
+__C.DIST.RANK = 0
+__C.DIST.WORLD_SIZE = 1
+__C.DIST.LOCAL_RANK = 0
 
 __C.TREE = edict()
 __C.TREE.BRANCH_NUM = 3
@@ -29,6 +47,7 @@ __C.TREE.BASE_SIZE = 64
 __C.TEST = edict()
 __C.TEST.B_EXAMPLE = True
 __C.TEST.SAMPLE_NUM = 30000
+__C.TEST.WRITE_WORKERS = 4  # threads encoding and writing images
 
 
 # Training options
@@ -36,12 +55,41 @@ __C.TRAIN = edict()
 __C.TRAIN.BATCH_SIZE = 64
 __C.TRAIN.VIS_COUNT = 64
 __C.TRAIN.MAX_EPOCH = 600
+__C.TRAIN.MAX_STEPS = 0  # stop after this many steps of this run, 0: no limit
 __C.TRAIN.SNAPSHOT_INTERVAL = 2000
 __C.TRAIN.DISCRIMINATOR_LR = 2e-4
 __C.TRAIN.GENERATOR_LR = 2e-4
 __C.TRAIN.FLAG = True
+__C.TRAIN.INCEPTION_SCORE = True  # IS of the fakes during training
 __C.TRAIN.NET_G = '' # netG_214000.pth
 __C.TRAIN.NET_D = '' # netD
+# Split each batch into micro-batches of this size and accumulate their
+# gradients before the optimizer steps; 0 disables
+__C.TRAIN.MICRO_BATCH = 0
+# Activation checkpointing, by stage index (0: 64x64, 1: 128x128, ...)
+__C.TRAIN.CHECKPOINT = edict()
+__C.TRAIN.CHECKPOINT.G_STAGES = []
+__C.TRAIN.CHECKPOINT.D_STAGES = []
+# Progressive training: stage i + 1 (and its D and image level) is only
+# computed from step STAGE_STEPS[i] on
+__C.TRAIN.PROGRESSIVE = edict()
+__C.TRAIN.PROGRESSIVE.FLAG = False
+__C.TRAIN.PROGRESSIVE.STAGE_STEPS = []
+# Update D_i every D_UPDATE_INTERVAL[i] steps, e.g. [1, 1, 2]; missing
+# entries mean every step
+__C.TRAIN.D_UPDATE_INTERVAL = []
+# torch.compile the encoder, G and the Ds (needs torch >= 2.2); MODE is
+# passed on, e.g. 'default', 'reduce-overhead' or 'max-autotune'
+__C.TRAIN.COMPILE = edict()
+__C.TRAIN.COMPILE.FLAG = False
+__C.TRAIN.COMPILE.MODE = 'default'
+
+# Per-phase step timing, written to Log/timing.csv and TensorBoard
+__C.TRAIN.TIMING = edict()
+__C.TRAIN.TIMING.FLAG = False
+__C.TRAIN.TIMING.SYNC = False  # synchronize the device around each phase
+__C.TRAIN.TIMING.INTERVAL = 100
+__C.TRAIN.TIMING.STARVE_MS = 1.0  # a data wait above this counts as starved
 
 __C.TRAIN.COEFF = edict()
 __C.TRAIN.COEFF.KL = 2.0
@@ -49,6 +97,16 @@ __C.TRAIN.COEFF.UNCOND_LOSS = 0.0
 __C.TRAIN.COEFF.COLOR_LOSS = 0.0
 
 
+# torch.profiler capture over a range of train/evaluate steps
+__C.PROFILE = edict()
+__C.PROFILE.FLAG = False
+__C.PROFILE.START = 10  # first profiled step
+__C.PROFILE.STEPS = 5
+__C.PROFILE.MEMORY = True
+__C.PROFILE.STACK = False
+__C.PROFILE.TOP_N = 30
+
+
 # Modal options
 __C.GAN = edict()
 __C.GAN.EMBEDDING_DIM = 128
@@ -58,6 +116,14 @@ __C.GAN.Z_DIM = 100
 __C.GAN.NETWORK_TYPE = 'default'
 __C.GAN.R_NUM = 2
 __C.GAN.B_CONDITION = False
+# D heads return raw logits and the losses use BCEWithLogitsLoss
+__C.GAN.D_LOGITS = False
+# Joint convs add the condition code as a per-channel term instead of
+# convolving a repeated copy of it (same result and weights)
+__C.GAN.FACTORIZED_COND = True
+# G upsampling: 'nearest' (upsample then conv) or 'subpixel' (same weights
+# as a conv on the low-resolution input followed by pixel_shuffle)
+__C.GAN.UPBLOCK = 'nearest'
 
 __C.TEXT = edict()
 __C.TEXT.DIMENSION = 256
@@ -104,3 +170,8 @@ def cfg_from_file(filename):
         yaml_cfg = edict(yaml.load(f))
 
     _merge_a_into_b(yaml_cfg, __C)
+
+
+def cfg_from_dict(options):
+    """Merge a (nested) dict of options, e.g. one saved with a model."""
+    _merge_a_into_b(edict(options), __C)
@@ -0,0 +1,107 @@
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class InceptionScoreStats(object):
+    """Streaming inception score and NLPP over `num_samples` predictions.
+
+    Split j holds samples j * N // S to (j + 1) * N // S - 1, the same
+    contiguous splits as compute_inception_score. Per split only the
+    sum of p(y|x), of sum_y p log p and of -log max_y p are kept, so the
+    predictions are never stored. Stats of disjoint sample ranges, e.g.
+    from several processes, add up with merge().
+    """
+    def __init__(self, num_samples, num_splits=10, num_classes=1000):
+        self.num_samples = num_samples
+        self.num_splits = num_splits
+        self.bounds = np.arange(num_splits + 1) * num_samples // num_splits
+        self.count = np.zeros(num_splits, dtype=np.int64)
+        self.sum_p = np.zeros((num_splits, num_classes))
+        self.sum_plogp = np.zeros(num_splits)
+        self.sum_nlpp = np.zeros(num_splits)
+
+    def update(self, predictions, start):
+        # predictions: n x num_classes softmax outputs of samples start...
+        p = np.asarray(predictions, dtype=np.float64)
+        index = np.arange(start, start + p.shape[0])
+        split = np.searchsorted(self.bounds, index, side='right') - 1
+        logp = np.log(np.maximum(p, 1e-12))
+        np.add.at(self.count, split, 1)
+        np.add.at(self.sum_p, split, p)
+        np.add.at(self.sum_plogp, split, np.sum(p * logp, 1))
+        np.add.at(self.sum_nlpp, split, -np.max(logp, 1))
+
+    def merge(self, other):
+        assert other.num_samples == self.num_samples and \
+            other.num_splits == self.num_splits
+        self.count += other.count
+        self.sum_p += other.sum_p
+        self.sum_plogp += other.sum_plogp
+        self.sum_nlpp += other.sum_nlpp
+
+    def scores(self):
+        # (IS mean, IS std, NLPP mean, NLPP std) over the splits
+        n = np.maximum(self.count, 1)
+        p_y = self.sum_p / n[:, None]
+        # mean_x KL(p(y|x) || p(y)) = mean_x sum p log p - sum p(y) log p(y)
+        kl = self.sum_plogp / n - \
+            np.sum(p_y * np.log(np.maximum(p_y, 1e-12)), 1)
+        inception = np.exp(kl)
+        nlpp = self.sum_nlpp / n
+        return np.mean(inception), np.std(inception), \
+            np.mean(nlpp), np.std(nlpp)
+
+    def save(self, path):
+        np.savez(path, num_samples=self.num_samples, count=self.count,
+                 sum_p=self.sum_p, sum_plogp=self.sum_plogp,
+                 sum_nlpp=self.sum_nlpp)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        stats = cls(int(data['num_samples']), data['sum_p'].shape[0],
+                    data['sum_p'].shape[1])
+        stats.count = data['count']
+        stats.sum_p = data['sum_p']
+        stats.sum_plogp = data['sum_plogp']
+        stats.sum_nlpp = data['sum_nlpp']
+        return stats
+
+
+class FeatureStats(object):
+    """Streaming mean and covariance of feature vectors, in float64."""
+    def __init__(self, dim=2048):
+        self.count = 0
+        self.sum = np.zeros(dim)
+        self.sum_outer = np.zeros((dim, dim))
+
+    def update(self, features):
+        x = np.asarray(features, dtype=np.float64)
+        self.count += x.shape[0]
+        self.sum += x.sum(0)
+        self.sum_outer += x.T.dot(x)
+
+    def mean_covariance(self):
+        mu = self.sum / self.count
+        sigma = (self.sum_outer - self.count * np.outer(mu, mu)) / \
+            max(self.count - 1, 1)
+        return mu, sigma
+
+    def save(self, path, **meta):
+        mu, sigma = self.mean_covariance()
+        np.savez(path, mu=mu, sigma=sigma, count=self.count, **meta)
+
+
+def frechet_distance(mu1, sigma1, mu2, sigma2):
+    # |mu1 - mu2|^2 + Tr(S1 + S2 - 2 (S1 S2)^1/2). Tr (S1 S2)^1/2 is the
+    # trace of (S1^1/2 S2 S1^1/2)^1/2, a symmetric PSD matrix, so two
+    # eigendecompositions replace the general matrix square root.
+    eigval, eigvec = np.linalg.eigh(sigma1)
+    sqrt1 = (eigvec * np.sqrt(np.maximum(eigval, 0))).dot(eigvec.T)
+    middle = sqrt1.dot(sigma2).dot(sqrt1)
+    tr_covmean = np.sum(np.sqrt(np.maximum(np.linalg.eigvalsh(middle), 0)))
+    diff = mu1 - mu2
+    return diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2) - \
+        2 * tr_covmean
@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+import os
+import threading
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function, schedule
+
+from miscc.config import cfg
+from miscc.utils import mkdir_p
+
+
+# Modules that get their own labelled range in the trace and the summary
+PROFILED_MODULES = ('encoder_resnet', 'CA_NET', 'INIT_STAGE_G',
+                    'NEXT_STAGE_G', 'GET_IMAGE_G', 'D_NET64', 'D_NET128',
+                    'D_NET256', 'D_NET512', 'D_NET1024', 'INCEPTION_V3')
+
+
+def _label_hooks(module, name):
+    # DataParallel runs replicas in threads, so keep one stack per thread
+    local = threading.local()
+
+    def pre_hook(m, inputs):
+        rf = record_function(name)
+        rf.__enter__()
+        if not hasattr(local, 'ranges'):
+            local.ranges = []
+        local.ranges.append(rf)
+
+    def post_hook(m, inputs, outputs):
+        if getattr(local, 'ranges', None):
+            local.ranges.pop().__exit__(None, None, None)
+
+    return [module.register_forward_pre_hook(pre_hook),
+            module.register_forward_hook(post_hook)]
+
+
+class StepProfiler(object):
+    """Capture a torch.profiler trace over cfg.PROFILE.STEPS steps.
+
+    Profiling starts at step cfg.PROFILE.START of the loop. When the
+    window closes the chrome trace and a top-N operator table are
+    written to `log_dir`, prefixed with `name`.
+    """
+    def __init__(self, log_dir, name, nets=()):
+        self.enabled = cfg.PROFILE.FLAG
+        self.log_dir = log_dir
+        self.name = name
+        self.nets = nets
+        self.handles = []
+        self.prof = None
+
+    def start(self):
+        if not self.enabled:
+            return
+        activities = [ProfilerActivity.CPU]
+        if cfg.CUDA:
+            activities.append(ProfilerActivity.CUDA)
+        warmup = 1 if cfg.PROFILE.START > 0 else 0
+        wait = max(cfg.PROFILE.START - warmup, 0)
+        self.prof = profile(
+            activities=activities,
+            schedule=schedule(wait=wait, warmup=warmup,
+                              active=cfg.PROFILE.STEPS, repeat=1),
+            on_trace_ready=self.save,
+            record_shapes=True,
+            profile_memory=cfg.PROFILE.MEMORY,
+            with_stack=cfg.PROFILE.STACK)
+        for net in self.nets:
+            for module in net.modules():
+                cls_name = module.__class__.__name__
+                if cls_name in PROFILED_MODULES:
+                    self.handles.extend(_label_hooks(module, cls_name))
+        self.prof.__enter__()
+        print('Profiling %s steps %d-%d' %
+              (self.name, cfg.PROFILE.START,
+               cfg.PROFILE.START + cfg.PROFILE.STEPS - 1))
+
+    def step(self):
+        if self.prof is not None:
+            self.prof.step()
+
+    def stop(self):
+        if self.prof is None:
+            return
+        self.prof.__exit__(None, None, None)
+        self.prof = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def save(self, prof):
+        # only rank 0 creates the trainer's directories; other ranks may
+        # not share its filesystem
+        mkdir_p(self.log_dir)
+        trace_path = os.path.join(self.log_dir, '%s_trace.json' % self.name)
+        prof.export_chrome_trace(trace_path)
+
+        sort_by = 'self_cuda_time_total' if cfg.CUDA else 'self_cpu_time_total'
+        tables = [prof.key_averages().table(sort_by=sort_by,
+                                            row_limit=cfg.PROFILE.TOP_N)]
+        if cfg.PROFILE.MEMORY:
+            mem_sort = 'self_cuda_memory_usage' if cfg.CUDA \
+                else 'self_cpu_memory_usage'
+            tables.append(prof.key_averages().table(
+                sort_by=mem_sort, row_limit=cfg.PROFILE.TOP_N))
+        if cfg.PROFILE.STACK:
+            tables.append(prof.key_averages(group_by_stack_n=5).table(
+                sort_by=sort_by, row_limit=cfg.PROFILE.TOP_N))
+        summary_path = os.path.join(self.log_dir, '%s_ops.txt' % self.name)
+        with open(summary_path, 'w') as f:
+            f.write('\n\n'.join(tables))
+        print('Saved profiler trace to', trace_path)
+        print(tables[0])
@@ -0,0 +1,154 @@
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import time
+
+import torch
+from torch.profiler import record_function
+from tensorboardX import summary
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.range = None
+        if self.timer.record_functions:
+            self.range = record_function(self.name)
+            self.range.__enter__()
+        if self.timer.enabled:
+            self.timer.synchronize()
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.timer.enabled:
+            self.timer.synchronize()
+            self.timer.add(self.name, time.perf_counter() - self.start)
+        if self.range is not None:
+            self.range.__exit__(None, None, None)
+        return False
+
+
+class StepTimer(object):
+    """Accumulate the wall time of each phase of a training step.
+
+    Every `interval` steps the mean time per step of each phase, the
+    fraction of time spent waiting on the DataLoader, the fraction of
+    starved steps and the images/s are written to a CSV row and to
+    TensorBoard. When `enabled` is False every call is a no-op.
+    With `record_functions` each phase is also labelled in profiler traces.
+    `tags` are constant columns added to every CSV row, e.g. the schedule
+    the run was trained with.
+    """
+    def __init__(self, phases, enabled=False, sync=False, interval=100,
+                 starve_ms=1.0, csv_path=None, summary_writer=None,
+                 record_functions=False, tags=None):
+        self.phases = list(phases)
+        self.tags = dict(tags or {})
+        self.enabled = enabled
+        self.record_functions = record_functions
+        self.sync = sync and torch.cuda.is_available()
+        self.interval = max(1, interval)
+        self.starve_s = starve_ms / 1000.0
+        self.summary_writer = summary_writer
+        self.csv_file = None
+        self.csv_writer = None
+        if enabled and csv_path is not None:
+            self.csv_file = open(csv_path, 'w')
+            fields = ['count', 'steps'] + \
+                ['%s_ms' % name for name in self.phases] + \
+                ['data_wait_frac', 'starved_frac', 'images_per_sec'] + \
+                sorted(self.tags)
+            self.csv_writer = csv.DictWriter(self.csv_file, fields,
+                                             extrasaction='ignore')
+            self.csv_writer.writeheader()
+        self.reset()
+        self.last = time.perf_counter()
+
+    def reset(self):
+        self.totals = dict((name, 0.0) for name in self.phases)
+        self.steps = 0
+        self.starved = 0
+        self.images = 0
+        self.start = time.perf_counter()
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def phase(self, name):
+        if not self.enabled and not self.record_functions:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def mark(self):
+        # Time from here until data_ready() is counted as data wait
+        self.last = time.perf_counter()
+
+    def data_ready(self):
+        if not self.enabled:
+            return
+        wait = time.perf_counter() - self.last
+        self.add('data_wait', wait)
+        if wait > self.starve_s:
+            self.starved += 1
+
+    def end_step(self, count, num_images):
+        if not self.enabled:
+            return
+        self.steps += 1
+        self.images += num_images
+        if count % self.interval == 0:
+            self.flush(count)
+        self.mark()
+
+    def stats(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-12)
+        steps = max(self.steps, 1)
+        row = {'steps': self.steps,
+               'data_wait_frac': self.totals.get('data_wait', 0.0) / elapsed,
+               'starved_frac': self.starved / steps,
+               'images_per_sec': self.images / elapsed}
+        for name, total in self.totals.items():
+            row['%s_ms' % name] = 1000.0 * total / steps
+        return row
+
+    def flush(self, count):
+        if not self.enabled or self.steps == 0:
+            return
+        row = self.stats()
+        row['count'] = count
+        if self.csv_writer is not None:
+            row.update(self.tags)
+            self.csv_writer.writerow(row)
+            self.csv_file.flush()
+        if self.summary_writer is not None:
+            for key in sorted(row):
+                if key in ('count', 'steps') or key in self.tags:
+                    continue
+                summ = summary.scalar('time/%s' % key, row[key])
+                self.summary_writer.add_summary(summ, count)
+        self.reset()
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
@@ -9,3 +9,52 @@ def mkdir_p(path):
             pass
         else:
             raise
+
+
+def get_rank():
+    import torch.distributed as dist
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def _save_png(ndarr, path):
+    from PIL import Image
+    Image.fromarray(ndarr).save(path)
+
+
+class ImageWriter(object):
+    """Encode and write uint8 H x W x 3 arrays as PNGs on a thread pool.
+
+    At most `max_pending` images are queued; write() blocks beyond that.
+    Folders are created once, by make_dirs().
+    """
+    def __init__(self, num_workers=4, max_pending=256):
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+        self.pool = ThreadPoolExecutor(max(1, num_workers))
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.folders = set()
+        self.count = 0
+
+    def make_dirs(self, paths):
+        for folder in set(os.path.dirname(path) for path in paths):
+            if folder not in self.folders:
+                mkdir_p(folder)
+                self.folders.add(folder)
+
+    def write(self, ndarr, path):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(_save_png, ndarr, path))
+        self.count += 1
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.pool.shutdown()
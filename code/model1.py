@@ -1,33 +1,59 @@
 
+from contextlib import contextmanager
+import os
+
 import torch
 import torch.nn as nn
 import torch.nn.parallel
 from miscc.config import cfg
 from torch.autograd import Variable
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torchvision import models
 import torch.utils.model_zoo as model_zoo
 
 
+# ImageNet weights of the pretrained models, by torchvision name
+PRETRAINED_URLS = {
+    'resnet50': 'https://download.pytorch.org/models/resnet50-0676ba61.pth',
+    'inception_v3':
+        'https://download.pytorch.org/models/inception_v3_google-1a9a5a14.pth',
+}
+
+
+def pretrained_state_dict(name):
+    # From cfg.WEIGHTS_DIR (filled by fetch_weights.py) if set, memory-mapped:
+    # load_state_dict still reads every tensor, but straight from the page
+    # cache, without deserializing into a second in-memory copy first.
+    # Otherwise from the torch hub cache, downloading on a miss.
+    url = PRETRAINED_URLS[name]
+    if cfg.WEIGHTS_DIR != '':
+        path = os.path.join(cfg.WEIGHTS_DIR, os.path.basename(url))
+        if not os.path.isfile(path):
+            raise IOError('%s not found, run fetch_weights.py --out %s' %
+                          (path, cfg.WEIGHTS_DIR))
+        return torch.load(path, map_location='cpu', mmap=True,
+                          weights_only=True)
+    return model_zoo.load_url(url, map_location='cpu')
+
+
 # ############################## For Compute inception score ##############################
 # Besides the inception score computed by pretrained model, especially for fine-grained datasets (such as birds, bedroom),
 #  it is also good to compute inception score using fine-tuned model and manually examine the image quality.
 class INCEPTION_V3(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(INCEPTION_V3, self).__init__()
-        self.model = models.inception_v3()
-        url = 'https://download.pytorch.org/models/inception_v3_google-1a9a5a14.pth'
-        # print(next(model.parameters()).data)
-        state_dict = \
-            model_zoo.load_url(url, map_location=lambda storage, loc: storage)
-        self.model.load_state_dict(state_dict)
+        # no random init of weights that are overwritten right away
+        self.model = models.inception_v3(init_weights=not pretrained)
+        if pretrained:
+            self.model.load_state_dict(pretrained_state_dict('inception_v3'))
+            print('Load pretrained inception_v3')
         for param in self.model.parameters():
             param.requires_grad = False
-        print('Load pretrained model from ', url)
         # print(next(self.model.parameters()).data)
         # print(self.model)
 
-    def forward(self, input):
+    def prepare(self, input):
         # [-1.0, 1.0] --> [0, 1.0]
         x = input * 0.5 + 0.5
         # mean=[0.485, 0.456, 0.406] and std=[0.229, 0.224, 0.225]
@@ -37,22 +63,70 @@ class INCEPTION_V3(nn.Module):
         x[:, 2] = (x[:, 2] - 0.406) / 0.225
         #
         # --> fixed-size input: batch x 3 x 299 x 299
-        x = nn.Upsample(size=(299, 299), mode='bilinear')(x)
+        return F.interpolate(x, size=(299, 299), mode='bilinear',
+                             align_corners=False)
+
+    def forward(self, input):
         # 299 x 299 x 3
-        x = self.model(x)
-        x = nn.Softmax()(x)
+        x = self.model(self.prepare(input))
+        x = F.softmax(x, 1)
         return x
 
+    def features(self, input):
+        # 2048-d pool3 features (the input of the last fc layer), for FID
+        pooled = []
+        handle = self.model.avgpool.register_forward_hook(
+            lambda m, inputs, output: pooled.append(output))
+        try:
+            self.model(self.prepare(input))
+        finally:
+            handle.remove()
+        return pooled[0].flatten(1)
+
 
 class GLU(nn.Module):
     def __init__(self):
         super(GLU, self).__init__()
 
     def forward(self, x):
-        nc = x.size(1)
-        assert nc % 2 == 0, 'channels dont divide 2!'
-        nc = int(nc/2)
-        return x[:, :nc] * F.sigmoid(x[:, nc:])
+        assert x.size(1) % 2 == 0, 'channels dont divide 2!'
+        return F.glu(x, 1)
+
+
+@contextmanager
+def frozen_bn_stats(*nets):
+    # Run BatchNorm on batch statistics without touching the running ones
+    saved = []
+    for net in nets:
+        for m in net.modules():
+            if isinstance(m, nn.modules.batchnorm._BatchNorm):
+                saved.append((m, m.momentum))
+                m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum in saved:
+            m.momentum = momentum
+
+
+def run_block(block, x, use_checkpoint=False):
+    # With use_checkpoint the activations inside `block` are recomputed in
+    # backward instead of stored; BatchNorm running statistics are only
+    # updated by the first pass. A tuple `x` is passed as several inputs.
+    inputs = x if isinstance(x, tuple) else (x,)
+    if not (use_checkpoint and torch.is_grad_enabled()):
+        return block(*inputs)
+    state = {'recompute': False}
+    # `block` may also be a bound method of a module
+    owner = getattr(block, '__self__', block)
+
+    def run(*inp):
+        if state['recompute']:
+            with frozen_bn_stats(owner):
+                return block(*inp)
+        state['recompute'] = True
+        return block(*inp)
+    return checkpoint(run, *inputs, use_reentrant=False)
 
 
 def conv3x3(in_planes, out_planes):
@@ -61,16 +135,112 @@ def conv3x3(in_planes, out_planes):
                      padding=1, bias=False)
 
 
+def cond_conv3x3(conv, h_code, c_code):
+    """conv3x3 of cat((c_code repeated over h_code's grid, h_code), 1).
+
+    h_code is convolved with the h part of the weight. The condition,
+    constant over the grid, adds a per-channel term whose border rows and
+    columns lose the kernel taps that fall on the zero padding. The
+    repeated condition map is never built.
+    """
+    ef_dim = c_code.size(1)
+    weight = conv.weight
+    out_code = F.conv2d(h_code, weight[:, ef_dim:], None, 1, 1)
+    width = out_code.size(3)
+    # response of each kernel tap to the condition: batch x out x 3 x 3
+    taps = torch.einsum('bc,ocij->boij', c_code, weight[:, :ef_dim])
+    # column j of the kernel reads column x + j - 1 of the input
+    col_mask = torch.ones(3, width, dtype=taps.dtype, device=taps.device)
+    col_mask[0, 0] = 0
+    col_mask[2, width - 1] = 0
+    # batch x out x 3 x width: kernel row i summed over valid columns
+    rows = torch.matmul(taps, col_mask)
+    out_code = out_code + rows.sum(2, keepdim=True)
+    # the first and last output rows have kernel rows 0 and 2 on padding
+    out_code[:, :, 0] -= rows[:, :, 0]
+    out_code[:, :, -1] -= rows[:, :, 2]
+    if conv.bias is not None:
+        out_code = out_code + conv.bias.view(1, -1, 1, 1)
+    return out_code
+
+
+class JointConv(nn.Sequential):
+    # conv3x3 block on the condition code joined to h_code. The modules are
+    # those of Block3x3_relu / Block3x3_leakRelu, so the keys are the same.
+    def __init__(self, cond_dim, *modules):
+        super(JointConv, self).__init__(*modules)
+        self.cond_dim = cond_dim
+        self.factorized = cfg.GAN.FACTORIZED_COND
+
+    def forward(self, h_code, c_code):
+        c_code = c_code.view(-1, self.cond_dim)
+        if self.factorized:
+            out_code = cond_conv3x3(self[0], h_code, c_code)
+        else:
+            s_size = h_code.size(2)
+            c_code = c_code.view(-1, self.cond_dim, 1, 1)
+            c_code = c_code.repeat(1, 1, s_size, h_code.size(3))
+            out_code = self[0](torch.cat((c_code, h_code), 1))
+        for i, module in enumerate(self):
+            if i > 0:
+                out_code = module(out_code)
+        return out_code
+
+
 # ############## G networks ################################################
+# Kernel rows of the 3x3 conv after a nearest 2x upsampling, as seen from
+# the low-resolution input: SUBPIXEL_TAPS[phase][low-res tap][kernel tap]
+SUBPIXEL_TAPS = torch.tensor([[[1., 0., 0.], [0., 1., 1.], [0., 0., 0.]],
+                              [[0., 0., 0.], [1., 1., 0.], [0., 0., 1.]]])
+
+
+class UpBlock(nn.Sequential):
+    """Nearest 2x upsampling, conv3x3, BatchNorm and GLU.
+
+    With GAN.UPBLOCK = 'subpixel' the same weights run as a 3x3 conv on
+    the low-resolution input that emits the four output phases, followed
+    by pixel_shuffle, so the upsampled input is never built. BatchNorm
+    and GLU run on the phase layout and are recomputed in backward, so
+    only the conv output is kept. The result and the state_dict are
+    those of the 'nearest' block.
+    """
+    def __init__(self, in_planes, out_planes):
+        super(UpBlock, self).__init__(
+            nn.Upsample(scale_factor=2, mode='nearest'),
+            conv3x3(in_planes, out_planes * 2),
+            nn.BatchNorm2d(out_planes * 2),
+            GLU())
+        assert cfg.GAN.UPBLOCK in ('nearest', 'subpixel'), cfg.GAN.UPBLOCK
+        self.subpixel = cfg.GAN.UPBLOCK == 'subpixel'
+
+    def subpixel_weight(self):
+        weight = self[1].weight
+        taps = SUBPIXEL_TAPS.to(weight)
+        # out x phase_y x phase_x x in x 3 x 3, i.e. channel out * 4 + phase
+        weight = torch.einsum('ptk,qsl,oikl->opqits', taps, taps, weight)
+        return weight.reshape(-1, weight.size(3), 3, 3)
+
+    def bn_glu(self, x):
+        b, c, h, w = x.size()
+        # group the four phases of a channel so BatchNorm sees all its pixels
+        x = self[2](x.view(b, c // 4, 4 * h, w))
+        x = F.glu(x, 1)
+        return F.pixel_shuffle(x.view(b, c // 2, h, w), 2)
+
+    def forward(self, x):
+        if not self.subpixel:
+            return super(UpBlock, self).forward(x)
+        bias = self[1].bias
+        if bias is not None:
+            # a conv with BatchNorm folded in (inference.fold_bn)
+            bias = bias.repeat_interleave(4)
+        out_code = F.conv2d(x, self.subpixel_weight(), bias, 1, 1)
+        return run_block(self.bn_glu, out_code, self.training)
+
+
 # Upsale the spatial size by a factor of 2
 def upBlock(in_planes, out_planes):
-    block = nn.Sequential(
-        nn.Upsample(scale_factor=2, mode='nearest'),
-        conv3x3(in_planes, out_planes * 2),
-        nn.BatchNorm2d(out_planes * 2),
-        GLU()
-    )
-    return block
+    return UpBlock(in_planes, out_planes)
 
 
 # Keep the spatial size
@@ -118,18 +288,16 @@ class CA_NET(nn.Module):
         logvar = x[:, self.ef_dim:]
         return mu, logvar
 
-    def reparametrize(self, mu, logvar):
+    def reparametrize(self, mu, logvar, eps=None):
+        # eps can be given, e.g. as an input of an exported graph
         std = logvar.mul(0.5).exp_()
-        if cfg.CUDA:
-            eps = torch.cuda.FloatTensor(std.size()).normal_()
-        else:
-            eps = torch.FloatTensor(std.size()).normal_()
-        eps = Variable(eps)
+        if eps is None:
+            eps = torch.randn_like(std)
         return eps.mul(std).add_(mu)
 
-    def forward(self, text_embedding):
+    def forward(self, text_embedding, eps=None):
         mu, logvar = self.encode(text_embedding)
-        c_code = self.reparametrize(mu, logvar)
+        c_code = self.reparametrize(mu, logvar, eps)
         return c_code, mu, logvar
 
 
@@ -137,7 +305,8 @@ class INIT_STAGE_G(nn.Module):
     def __init__(self, ngf):
         super(INIT_STAGE_G, self).__init__()
         self.gf_dim = ngf
-        if cfg.GAN.B_CONDITION:
+        self.b_condition = cfg.GAN.B_CONDITION
+        if self.b_condition:
             self.in_dim = cfg.GAN.Z_DIM + cfg.GAN.EMBEDDING_DIM
         else:
             self.in_dim = cfg.GAN.Z_DIM
@@ -156,23 +325,25 @@ class INIT_STAGE_G(nn.Module):
         self.upsample2 = upBlock(ngf // 2, ngf // 4)
         self.upsample3 = upBlock(ngf // 4, ngf // 8)
         self.upsample4 = upBlock(ngf // 8, ngf // 16)
+        self.use_checkpoint = False
 
     def forward(self, z_code, c_code=None):
-        if cfg.GAN.B_CONDITION and c_code is not None:
+        if self.b_condition and c_code is not None:
             in_code = torch.cat((c_code, z_code), 1)
         else:
             in_code = z_code
         # state size 16ngf x 4 x 4
         out_code = self.fc(in_code)
         out_code = out_code.view(-1, self.gf_dim, 4, 4)
+        ckpt = self.use_checkpoint and self.training
         # state size 8ngf x 8 x 8
-        out_code = self.upsample1(out_code)
+        out_code = run_block(self.upsample1, out_code, ckpt)
         # state size 4ngf x 16 x 16
-        out_code = self.upsample2(out_code)
+        out_code = run_block(self.upsample2, out_code, ckpt)
         # state size 2ngf x 32 x 32
-        out_code = self.upsample3(out_code)
+        out_code = run_block(self.upsample3, out_code, ckpt)
         # state size ngf x 64 x 64
-        out_code = self.upsample4(out_code)
+        out_code = run_block(self.upsample4, out_code, ckpt)
 
         return out_code
 
@@ -198,21 +369,20 @@ class NEXT_STAGE_G(nn.Module):
         ngf = self.gf_dim
         efg = self.ef_dim
 
-        self.jointConv = Block3x3_relu(ngf + efg, ngf)
+        self.jointConv = JointConv(efg, *Block3x3_relu(ngf + efg, ngf))
         self.residual = self._make_layer(ResBlock, ngf)
         self.upsample = upBlock(ngf, ngf // 2)
+        self.use_checkpoint = False
 
     def forward(self, h_code, c_code):
-        s_size = h_code.size(2)
-        c_code = c_code.view(-1, self.ef_dim, 1, 1)
-        c_code = c_code.repeat(1, 1, s_size, s_size)
-        # state size (ngf+egf) x in_size x in_size
-        h_c_code = torch.cat((c_code, h_code), 1)
+        ckpt = self.use_checkpoint and self.training
+        # conv over (ngf+egf) x in_size x in_size, without the repeat
         # state size ngf x in_size x in_size
-        out_code = self.jointConv(h_c_code)
-        out_code = self.residual(out_code)
+        out_code = run_block(self.jointConv, (h_code, c_code), ckpt)
+        for block in self.residual:
+            out_code = run_block(block, out_code, ckpt)
         # state size ngf/2 x 2in_size x 2in_size
-        out_code = self.upsample(out_code)
+        out_code = run_block(self.upsample, out_code, ckpt)
 
         return out_code
 
@@ -231,54 +401,81 @@ class GET_IMAGE_G(nn.Module):
         return out_img
 
 
+def stage_plan(branch_num, num_stages=None, out_stages=None):
+    # Stages to run and image heads to apply. With out_stages only those
+    # images are made (None in their place otherwise) and no stage above
+    # the highest of them is run.
+    if num_stages is None:
+        num_stages = branch_num
+    if out_stages is None:
+        return num_stages, range(num_stages)
+    out_stages = set(out_stages)
+    return min(num_stages, max(out_stages) + 1), out_stages
+
+
 class G_NET(nn.Module):
     def __init__(self):
         super(G_NET, self).__init__()
         self.gf_dim = cfg.GAN.GF_DIM
+        # read once here so that forward does not depend on the global cfg
+        self.b_condition = cfg.GAN.B_CONDITION
+        self.branch_num = cfg.TREE.BRANCH_NUM
         self.define_module()
 
     def define_module(self):
-        if cfg.GAN.B_CONDITION:
+        if self.b_condition:
             self.ca_net = CA_NET()
 
-        if cfg.TREE.BRANCH_NUM > 0:
+        if self.branch_num > 0:
             self.h_net1 = INIT_STAGE_G(self.gf_dim * 16)
             self.img_net1 = GET_IMAGE_G(self.gf_dim)
-        if cfg.TREE.BRANCH_NUM > 1:
+        if self.branch_num > 1:
             self.h_net2 = NEXT_STAGE_G(self.gf_dim)
             self.img_net2 = GET_IMAGE_G(self.gf_dim // 2)
-        if cfg.TREE.BRANCH_NUM > 2:
+        if self.branch_num > 2:
             self.h_net3 = NEXT_STAGE_G(self.gf_dim // 2)
             self.img_net3 = GET_IMAGE_G(self.gf_dim // 4)
-        if cfg.TREE.BRANCH_NUM > 3: # Recommended structure (mainly limited by GPU memory), and not test yet
+        if self.branch_num > 3: # Recommended structure (mainly limited by GPU memory), and not test yet
             self.h_net4 = NEXT_STAGE_G(self.gf_dim // 4, num_residual=1)
             self.img_net4 = GET_IMAGE_G(self.gf_dim // 8)
-        if cfg.TREE.BRANCH_NUM > 4:
+        if self.branch_num > 4:
             self.h_net4 = NEXT_STAGE_G(self.gf_dim // 8, num_residual=1)
             self.img_net4 = GET_IMAGE_G(self.gf_dim // 16)
-
-    def forward(self, z_code, text_embedding=None):
-        if cfg.GAN.B_CONDITION and text_embedding is not None:
-            c_code, mu, logvar = self.ca_net(text_embedding)
+        self.set_checkpoint(cfg.TRAIN.CHECKPOINT.G_STAGES)
+
+    def set_checkpoint(self, stages):
+        # activation checkpointing for the listed stages (0 is 64x64)
+        for i in range(self.branch_num):
+            h_net = getattr(self, 'h_net%d' % (i + 1), None)
+            if h_net is not None:
+                h_net.use_checkpoint = i in stages
+
+    def forward(self, z_code, text_embedding=None, num_stages=None,
+                out_stages=None, eps=None):
+        # only the first num_stages stages are computed (progressive training)
+        num_stages, out_stages = \
+            stage_plan(self.branch_num, num_stages, out_stages)
+        if self.b_condition and text_embedding is not None:
+            c_code, mu, logvar = self.ca_net(text_embedding, eps)
         else:
             c_code, mu, logvar = z_code, None, None
         fake_imgs = []
-        if cfg.TREE.BRANCH_NUM > 0:
+        if num_stages > 0:
             h_code1 = self.h_net1(z_code, c_code)
-            fake_img1 = self.img_net1(h_code1)
-            fake_imgs.append(fake_img1)
-        if cfg.TREE.BRANCH_NUM > 1:
+            fake_imgs.append(self.img_net1(h_code1)
+                             if 0 in out_stages else None)
+        if num_stages > 1:
             h_code2 = self.h_net2(h_code1, c_code)
-            fake_img2 = self.img_net2(h_code2)
-            fake_imgs.append(fake_img2)
-        if cfg.TREE.BRANCH_NUM > 2:
+            fake_imgs.append(self.img_net2(h_code2)
+                             if 1 in out_stages else None)
+        if num_stages > 2:
             h_code3 = self.h_net3(h_code2, c_code)
-            fake_img3 = self.img_net3(h_code3)
-            fake_imgs.append(fake_img3)
-        if cfg.TREE.BRANCH_NUM > 3:
+            fake_imgs.append(self.img_net3(h_code3)
+                             if 2 in out_stages else None)
+        if num_stages > 3:
             h_code4 = self.h_net4(h_code3, c_code)
-            fake_img4 = self.img_net4(h_code4)
-            fake_imgs.append(fake_img4)
+            fake_imgs.append(self.img_net4(h_code4)
+                             if 3 in out_stages else None)
 
         return fake_imgs, mu, logvar
 
@@ -290,52 +487,63 @@ class G_NET1(nn.Module):
     def __init__(self):
         super(G_NET1, self).__init__()
         self.gf_dim = cfg.GAN.GF_DIM
+        self.branch_num = cfg.TREE.BRANCH_NUM
         self.define_module()
 
     def define_module(self):
         #if cfg.GAN.B_CONDITION:
             #self.ca_net = CA_NET()
 
-        if cfg.TREE.BRANCH_NUM > 0:
+        if self.branch_num > 0:
             self.h_net1 = INIT_STAGE_G(self.gf_dim * 16)
             self.img_net1 = GET_IMAGE_G(self.gf_dim)
-        if cfg.TREE.BRANCH_NUM > 1:
+        if self.branch_num > 1:
             self.h_net2 = NEXT_STAGE_G(self.gf_dim)
             self.img_net2 = GET_IMAGE_G(self.gf_dim // 2)
-        if cfg.TREE.BRANCH_NUM > 2:
+        if self.branch_num > 2:
             self.h_net3 = NEXT_STAGE_G(self.gf_dim // 2)
             self.img_net3 = GET_IMAGE_G(self.gf_dim // 4)
-        if cfg.TREE.BRANCH_NUM > 3: # Recommended structure (mainly limited by GPU memory), and not test yet
+        if self.branch_num > 3: # Recommended structure (mainly limited by GPU memory), and not test yet
             self.h_net4 = NEXT_STAGE_G(self.gf_dim // 4, num_residual=1)
             self.img_net4 = GET_IMAGE_G(self.gf_dim // 8)
-        if cfg.TREE.BRANCH_NUM > 4:
+        if self.branch_num > 4:
             self.h_net4 = NEXT_STAGE_G(self.gf_dim // 8, num_residual=1)
             self.img_net4 = GET_IMAGE_G(self.gf_dim // 16)
+        self.set_checkpoint(cfg.TRAIN.CHECKPOINT.G_STAGES)
 
-    def forward(self, z_code, c_code=None):
+    def set_checkpoint(self, stages):
+        # activation checkpointing for the listed stages (0 is 64x64)
+        for i in range(self.branch_num):
+            h_net = getattr(self, 'h_net%d' % (i + 1), None)
+            if h_net is not None:
+                h_net.use_checkpoint = i in stages
+
+    def forward(self, z_code, c_code=None, num_stages=None, out_stages=None):
         #if cfg.GAN.B_CONDITION and text_embedding is not None:
             #c_code, mu, logvar = self.ca_net(text_embedding)
         #else:
          #   c_code, mu, logvar = z_code, None, None
         if c_code is  None:
              c_code= z_code
+        num_stages, out_stages = \
+            stage_plan(self.branch_num, num_stages, out_stages)
         fake_imgs = []
-        if cfg.TREE.BRANCH_NUM > 0:
+        if num_stages > 0:
             h_code1 = self.h_net1(z_code, c_code)
-            fake_img1 = self.img_net1(h_code1)
-            fake_imgs.append(fake_img1)
-        if cfg.TREE.BRANCH_NUM > 1:
+            fake_imgs.append(self.img_net1(h_code1)
+                             if 0 in out_stages else None)
+        if num_stages > 1:
             h_code2 = self.h_net2(h_code1, c_code)
-            fake_img2 = self.img_net2(h_code2)
-            fake_imgs.append(fake_img2)
-        if cfg.TREE.BRANCH_NUM > 2:
+            fake_imgs.append(self.img_net2(h_code2)
+                             if 1 in out_stages else None)
+        if num_stages > 2:
             h_code3 = self.h_net3(h_code2, c_code)
-            fake_img3 = self.img_net3(h_code3)
-            fake_imgs.append(fake_img3)
-        if cfg.TREE.BRANCH_NUM > 3:
+            fake_imgs.append(self.img_net3(h_code3)
+                             if 2 in out_stages else None)
+        if num_stages > 3:
             h_code4 = self.h_net4(h_code3, c_code)
-            fake_img4 = self.img_net4(h_code4)
-            fake_imgs.append(fake_img4)
+            fake_imgs.append(self.img_net4(h_code4)
+                             if 3 in out_stages else None)
 
         return fake_imgs
 
@@ -381,6 +589,15 @@ def encode_image_by_16times(ndf):
     return encode_img
 
 
+# Real/fake score of a 4 x 4 code; with GAN.D_LOGITS the sigmoid is left
+# to the loss. The conv stays at index 0 so netD*.pth loads either way.
+def logitsBlock(ndf):
+    layers = [nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4)]
+    if not cfg.GAN.D_LOGITS:
+        layers.append(nn.Sigmoid())
+    return nn.Sequential(*layers)
+
+
 ########################################################################
 #parameters
 CHANNELS = 3
@@ -480,6 +697,7 @@ class encoder2(nn.Module):
         super(encoder2, self).__init__()
         self.gf_dim = 64# cfg.GAN.GF_DIM
         self.in_dim = 1024 #cfg.TEXT.DIMENSION
+        self.b_condition = cfg.GAN.B_CONDITION
         self.define_module()
 
     # Encoder
@@ -496,7 +714,7 @@ class encoder2(nn.Module):
             nn.Linear(ngf * 4 * 4, in_dim * 2, bias=False),
             nn.BatchNorm1d(in_dim * 2),
             GLU())
-        if cfg.GAN.B_CONDITION:
+        if self.b_condition:
             self.ca_net = CA_NET()
         self.relu = nn.LeakyReLU(0.2)
         
@@ -513,7 +731,7 @@ class encoder2(nn.Module):
         
         out = out.view(-1, 16*self.gf_dim * 4 * 4)
         out = self.fc(out)
-        if cfg.GAN.B_CONDITION and out is not None:
+        if self.b_condition and out is not None:
             c_code, mu, logvar = self.ca_net(out)
         else:
             c_code, mu, logvar = None, None, None
@@ -532,7 +750,8 @@ class encoder_resnet1(nn.Module):
     # TODO : try with padding = 0
     def define_module(self):
         in_dim = self.in_dim
-        self.res = models.resnet50(pretrained=True)
+        self.res = models.resnet50()
+        self.res.load_state_dict(pretrained_state_dict('resnet50'))
         num_ftrs = self.res.fc.in_features
         #self.res.fc = nn.Linear(num_ftrs, in_dim)
         self.res.fc = nn.Linear(num_ftrs, in_dim) # double dimention
@@ -550,16 +769,19 @@ class encoder_resnet1(nn.Module):
 #################################
 class encoder_resnet(nn.Module):
     #does not include C_NET compatible with GNET
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super(encoder_resnet, self).__init__()
         self.in_dim = cfg.TEXT.DIMENSION
+        self.pretrained = pretrained
         self.define_module()
 
     # Encoder
     # TODO : try with padding = 0
     def define_module(self):
         in_dim = self.in_dim
-        self.res = models.resnet50(pretrained=True)
+        self.res = models.resnet50()
+        if self.pretrained:
+            self.res.load_state_dict(pretrained_state_dict('resnet50'))
         num_ftrs = self.res.fc.in_features
         #self.res.fc = nn.Linear(num_ftrs, in_dim)
         self.res.fc = nn.Linear(num_ftrs, in_dim) # double dimention
@@ -952,38 +1174,35 @@ class D_NET64(nn.Module):
         super(D_NET64, self).__init__()
         self.df_dim = cfg.GAN.DF_DIM
         self.ef_dim = cfg.GAN.EMBEDDING_DIM
+        self.b_condition = cfg.GAN.B_CONDITION
         self.define_module()
+        self.use_checkpoint = 0 in cfg.TRAIN.CHECKPOINT.D_STAGES
 
     def define_module(self):
         ndf = self.df_dim
         efg = self.ef_dim
         self.img_code_s16 = encode_image_by_16times(ndf)
 
-        self.logits = nn.Sequential(
-            nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-            nn.Sigmoid())
+        self.logits = logitsBlock(ndf)
 
-        if cfg.GAN.B_CONDITION:
-            self.jointConv = Block3x3_leakRelu(ndf * 8 + efg, ndf * 8)
-            self.uncond_logits = nn.Sequential(
-                nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-                nn.Sigmoid())
+        if self.b_condition:
+            self.jointConv = JointConv(
+                efg, *Block3x3_leakRelu(ndf * 8 + efg, ndf * 8))
+            self.uncond_logits = logitsBlock(ndf)
 
     def forward(self, x_var, c_code=None):
-        x_code = self.img_code_s16(x_var)
+        ckpt = self.use_checkpoint and self.training
+        x_code = run_block(self.img_code_s16, x_var, ckpt)
 
-        if cfg.GAN.B_CONDITION and c_code is not None:
-            c_code = c_code.view(-1, self.ef_dim, 1, 1)
-            c_code = c_code.repeat(1, 1, 4, 4)
-            # state size (ngf+egf) x 4 x 4
-            h_c_code = torch.cat((c_code, x_code), 1)
+        if self.b_condition and c_code is not None:
+            # conv over (ngf+egf) x 4 x 4, without the repeat
             # state size ngf x in_size x in_size
-            h_c_code = self.jointConv(h_c_code)
+            h_c_code = self.jointConv(x_code, c_code)
         else:
             h_c_code = x_code
 
         output = self.logits(h_c_code)
-        if cfg.GAN.B_CONDITION:
+        if self.b_condition:
             out_uncond = self.uncond_logits(x_code)
             return [output.view(-1), out_uncond.view(-1)]
         else:
@@ -996,7 +1215,9 @@ class D_NET128(nn.Module):
         super(D_NET128, self).__init__()
         self.df_dim = cfg.GAN.DF_DIM
         self.ef_dim = cfg.GAN.EMBEDDING_DIM
+        self.b_condition = cfg.GAN.B_CONDITION
         self.define_module()
+        self.use_checkpoint = 1 in cfg.TRAIN.CHECKPOINT.D_STAGES
 
     def define_module(self):
         ndf = self.df_dim
@@ -1005,33 +1226,28 @@ class D_NET128(nn.Module):
         self.img_code_s32 = downBlock(ndf * 8, ndf * 16)
         self.img_code_s32_1 = Block3x3_leakRelu(ndf * 16, ndf * 8)
 
-        self.logits = nn.Sequential(
-            nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-            nn.Sigmoid())
+        self.logits = logitsBlock(ndf)
 
-        if cfg.GAN.B_CONDITION:
-            self.jointConv = Block3x3_leakRelu(ndf * 8 + efg, ndf * 8)
-            self.uncond_logits = nn.Sequential(
-            nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-            nn.Sigmoid())
+        if self.b_condition:
+            self.jointConv = JointConv(
+                efg, *Block3x3_leakRelu(ndf * 8 + efg, ndf * 8))
+            self.uncond_logits = logitsBlock(ndf)
 
     def forward(self, x_var, c_code=None):
-        x_code = self.img_code_s16(x_var)
-        x_code = self.img_code_s32(x_code)
-        x_code = self.img_code_s32_1(x_code)
-
-        if cfg.GAN.B_CONDITION and c_code is not None:
-            c_code = c_code.view(-1, self.ef_dim, 1, 1)
-            c_code = c_code.repeat(1, 1, 4, 4)
-            # state size (ngf+egf) x 4 x 4
-            h_c_code = torch.cat((c_code, x_code), 1)
+        ckpt = self.use_checkpoint and self.training
+        x_code = run_block(self.img_code_s16, x_var, ckpt)
+        x_code = run_block(self.img_code_s32, x_code, ckpt)
+        x_code = run_block(self.img_code_s32_1, x_code, ckpt)
+
+        if self.b_condition and c_code is not None:
+            # conv over (ngf+egf) x 4 x 4, without the repeat
             # state size ngf x in_size x in_size
-            h_c_code = self.jointConv(h_c_code)
+            h_c_code = self.jointConv(x_code, c_code)
         else:
             h_c_code = x_code
 
         output = self.logits(h_c_code)
-        if cfg.GAN.B_CONDITION:
+        if self.b_condition:
             out_uncond = self.uncond_logits(x_code)
             return [output.view(-1), out_uncond.view(-1)]
         else:
@@ -1044,7 +1260,9 @@ class D_NET256(nn.Module):
         super(D_NET256, self).__init__()
         self.df_dim = cfg.GAN.DF_DIM
         self.ef_dim = cfg.GAN.EMBEDDING_DIM
+        self.b_condition = cfg.GAN.B_CONDITION
         self.define_module()
+        self.use_checkpoint = 2 in cfg.TRAIN.CHECKPOINT.D_STAGES
 
     def define_module(self):
         ndf = self.df_dim
@@ -1055,35 +1273,30 @@ class D_NET256(nn.Module):
         self.img_code_s64_1 = Block3x3_leakRelu(ndf * 32, ndf * 16)
         self.img_code_s64_2 = Block3x3_leakRelu(ndf * 16, ndf * 8)
 
-        self.logits = nn.Sequential(
-            nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-            nn.Sigmoid())
+        self.logits = logitsBlock(ndf)
 
-        if cfg.GAN.B_CONDITION:
-            self.jointConv = Block3x3_leakRelu(ndf * 8 + efg, ndf * 8)
-            self.uncond_logits = nn.Sequential(
-                nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-                nn.Sigmoid())
+        if self.b_condition:
+            self.jointConv = JointConv(
+                efg, *Block3x3_leakRelu(ndf * 8 + efg, ndf * 8))
+            self.uncond_logits = logitsBlock(ndf)
 
     def forward(self, x_var, c_code=None):
-        x_code = self.img_code_s16(x_var)
-        x_code = self.img_code_s32(x_code)
-        x_code = self.img_code_s64(x_code)
-        x_code = self.img_code_s64_1(x_code)
-        x_code = self.img_code_s64_2(x_code)
-
-        if cfg.GAN.B_CONDITION and c_code is not None:
-            c_code = c_code.view(-1, self.ef_dim, 1, 1)
-            c_code = c_code.repeat(1, 1, 4, 4)
-            # state size (ngf+egf) x 4 x 4
-            h_c_code = torch.cat((c_code, x_code), 1)
+        ckpt = self.use_checkpoint and self.training
+        x_code = run_block(self.img_code_s16, x_var, ckpt)
+        x_code = run_block(self.img_code_s32, x_code, ckpt)
+        x_code = run_block(self.img_code_s64, x_code, ckpt)
+        x_code = run_block(self.img_code_s64_1, x_code, ckpt)
+        x_code = run_block(self.img_code_s64_2, x_code, ckpt)
+
+        if self.b_condition and c_code is not None:
+            # conv over (ngf+egf) x 4 x 4, without the repeat
             # state size ngf x in_size x in_size
-            h_c_code = self.jointConv(h_c_code)
+            h_c_code = self.jointConv(x_code, c_code)
         else:
             h_c_code = x_code
 
         output = self.logits(h_c_code)
-        if cfg.GAN.B_CONDITION:
+        if self.b_condition:
             out_uncond = self.uncond_logits(x_code)
             return [output.view(-1), out_uncond.view(-1)]
         else:
@@ -1096,7 +1309,9 @@ class D_NET512(nn.Module):
         super(D_NET512, self).__init__()
         self.df_dim = cfg.GAN.DF_DIM
         self.ef_dim = cfg.GAN.EMBEDDING_DIM
+        self.b_condition = cfg.GAN.B_CONDITION
         self.define_module()
+        self.use_checkpoint = 3 in cfg.TRAIN.CHECKPOINT.D_STAGES
 
     def define_module(self):
         ndf = self.df_dim
@@ -1109,37 +1324,32 @@ class D_NET512(nn.Module):
         self.img_code_s128_2 = Block3x3_leakRelu(ndf * 32, ndf * 16)
         self.img_code_s128_3 = Block3x3_leakRelu(ndf * 16, ndf * 8)
 
-        self.logits = nn.Sequential(
-            nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-            nn.Sigmoid())
+        self.logits = logitsBlock(ndf)
 
-        if cfg.GAN.B_CONDITION:
-            self.jointConv = Block3x3_leakRelu(ndf * 8 + efg, ndf * 8)
-            self.uncond_logits = nn.Sequential(
-                nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-                nn.Sigmoid())
+        if self.b_condition:
+            self.jointConv = JointConv(
+                efg, *Block3x3_leakRelu(ndf * 8 + efg, ndf * 8))
+            self.uncond_logits = logitsBlock(ndf)
 
     def forward(self, x_var, c_code=None):
-        x_code = self.img_code_s16(x_var)
-        x_code = self.img_code_s32(x_code)
-        x_code = self.img_code_s64(x_code)
-        x_code = self.img_code_s128(x_code)
-        x_code = self.img_code_s128_1(x_code)
-        x_code = self.img_code_s128_2(x_code)
-        x_code = self.img_code_s128_3(x_code)
-
-        if cfg.GAN.B_CONDITION and c_code is not None:
-            c_code = c_code.view(-1, self.ef_dim, 1, 1)
-            c_code = c_code.repeat(1, 1, 4, 4)
-            # state size (ngf+egf) x 4 x 4
-            h_c_code = torch.cat((c_code, x_code), 1)
+        ckpt = self.use_checkpoint and self.training
+        x_code = run_block(self.img_code_s16, x_var, ckpt)
+        x_code = run_block(self.img_code_s32, x_code, ckpt)
+        x_code = run_block(self.img_code_s64, x_code, ckpt)
+        x_code = run_block(self.img_code_s128, x_code, ckpt)
+        x_code = run_block(self.img_code_s128_1, x_code, ckpt)
+        x_code = run_block(self.img_code_s128_2, x_code, ckpt)
+        x_code = run_block(self.img_code_s128_3, x_code, ckpt)
+
+        if self.b_condition and c_code is not None:
+            # conv over (ngf+egf) x 4 x 4, without the repeat
             # state size ngf x in_size x in_size
-            h_c_code = self.jointConv(h_c_code)
+            h_c_code = self.jointConv(x_code, c_code)
         else:
             h_c_code = x_code
 
         output = self.logits(h_c_code)
-        if cfg.GAN.B_CONDITION:
+        if self.b_condition:
             out_uncond = self.uncond_logits(x_code)
             return [output.view(-1), out_uncond.view(-1)]
         else:
@@ -1152,7 +1362,9 @@ class D_NET1024(nn.Module):
         super(D_NET1024, self).__init__()
         self.df_dim = cfg.GAN.DF_DIM
         self.ef_dim = cfg.GAN.EMBEDDING_DIM
+        self.b_condition = cfg.GAN.B_CONDITION
         self.define_module()
+        self.use_checkpoint = 4 in cfg.TRAIN.CHECKPOINT.D_STAGES
 
     def define_module(self):
         ndf = self.df_dim
@@ -1167,39 +1379,34 @@ class D_NET1024(nn.Module):
         self.img_code_s256_3 = Block3x3_leakRelu(ndf * 32, ndf * 16)
         self.img_code_s256_4 = Block3x3_leakRelu(ndf * 16, ndf * 8)
 
-        self.logits = nn.Sequential(
-            nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-            nn.Sigmoid())
+        self.logits = logitsBlock(ndf)
 
-        if cfg.GAN.B_CONDITION:
-            self.jointConv = Block3x3_leakRelu(ndf * 8 + efg, ndf * 8)
-            self.uncond_logits = nn.Sequential(
-                nn.Conv2d(ndf * 8, 1, kernel_size=4, stride=4),
-                nn.Sigmoid())
+        if self.b_condition:
+            self.jointConv = JointConv(
+                efg, *Block3x3_leakRelu(ndf * 8 + efg, ndf * 8))
+            self.uncond_logits = logitsBlock(ndf)
 
     def forward(self, x_var, c_code=None):
-        x_code = self.img_code_s16(x_var)
-        x_code = self.img_code_s32(x_code)
-        x_code = self.img_code_s64(x_code)
-        x_code = self.img_code_s128(x_code)
-        x_code = self.img_code_s256(x_code)
-        x_code = self.img_code_s256_1(x_code)
-        x_code = self.img_code_s256_2(x_code)
-        x_code = self.img_code_s256_3(x_code)
-        x_code = self.img_code_s256_4(x_code)
-
-        if cfg.GAN.B_CONDITION and c_code is not None:
-            c_code = c_code.view(-1, self.ef_dim, 1, 1)
-            c_code = c_code.repeat(1, 1, 4, 4)
-            # state size (ngf+egf) x 4 x 4
-            h_c_code = torch.cat((c_code, x_code), 1)
+        ckpt = self.use_checkpoint and self.training
+        x_code = run_block(self.img_code_s16, x_var, ckpt)
+        x_code = run_block(self.img_code_s32, x_code, ckpt)
+        x_code = run_block(self.img_code_s64, x_code, ckpt)
+        x_code = run_block(self.img_code_s128, x_code, ckpt)
+        x_code = run_block(self.img_code_s256, x_code, ckpt)
+        x_code = run_block(self.img_code_s256_1, x_code, ckpt)
+        x_code = run_block(self.img_code_s256_2, x_code, ckpt)
+        x_code = run_block(self.img_code_s256_3, x_code, ckpt)
+        x_code = run_block(self.img_code_s256_4, x_code, ckpt)
+
+        if self.b_condition and c_code is not None:
+            # conv over (ngf+egf) x 4 x 4, without the repeat
             # state size ngf x in_size x in_size
-            h_c_code = self.jointConv(h_c_code)
+            h_c_code = self.jointConv(x_code, c_code)
         else:
             h_c_code = x_code
 
         output = self.logits(h_c_code)
-        if cfg.GAN.B_CONDITION:
+        if self.b_condition:
             out_uncond = self.uncond_logits(x_code)
             return [output.view(-1), out_uncond.view(-1)]
         else:
@@ -0,0 +1,178 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantWrapper, convert, \
+    get_default_qconfig, prepare, quantize_dynamic
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+
+# int8 CPU inference builds of encoder_resnet + G_NET, benchmarked against
+# fp32 on latency, throughput and reconstruction error.
+#   dynamic: the Linear layers (res.fc, CA_NET.fc, INIT_STAGE_G.fc) with
+#            int8 weights and activations quantized on the fly
+#   static:  dynamic Linear layers in G, plus the ResNet-50 trunk and every
+#            G conv with int8 activations calibrated on the training data
+# GLU, the upsampling and the residual adds stay in float: each G conv is
+# quantized on its own, with BatchNorm folded into it first.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='int8 CPU inference')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--net_g', type=str, required=True)
+    parser.add_argument('--net_e', type=str, default='',
+                        help='encG_*.pth, next to netG_*.pth by default')
+    parser.add_argument('--mode', type=str, default='dynamic',
+                        choices=['dynamic', 'static'])
+    parser.add_argument('--engine', type=str, default='fbgemm',
+                        help='fbgemm (x86) or qnnpack (ARM)')
+    parser.add_argument('--calib_batches', type=int, default=16)
+    parser.add_argument('--eval_batches', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--out', type=str, default='',
+                        help='save the quantized encoder and G here')
+    parser.add_argument('--json', type=str, default='')
+    return parser.parse_args()
+
+
+def quantize_linear(net):
+    return quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8)
+
+
+def prepare_static_encoder(enc, qconfig):
+    # the quantizable torchvision ResNet-50 has the quant / dequant stubs
+    # and the conv + bn + relu fusion; the weights are those of enc.res
+    from torchvision.models.quantization import resnet50
+    res = resnet50(quantize=False)
+    res.fc = nn.Linear(res.fc.in_features, enc.res.fc.out_features)
+    res.load_state_dict(enc.res.state_dict())
+    res.eval()
+    res.fuse_model()
+    res.qconfig = qconfig
+    enc.res = prepare(res)
+    return enc
+
+
+def prepare_static_generator(netG, qconfig):
+    from inference import fold_bn
+    netG = fold_bn(netG)
+    # the factorized joint convs and sub-pixel upsampling read conv.weight
+    # directly, which a quantized conv does not have
+    for module in netG.modules():
+        if hasattr(module, 'factorized'):
+            module.factorized = False
+        if hasattr(module, 'subpixel'):
+            module.subpixel = False
+    for module in list(netG.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Conv2d):
+                wrapped = QuantWrapper(child)
+                wrapped.qconfig = qconfig
+                setattr(module, name, wrapped)
+    netG = prepare(netG)
+    return quantize_linear(netG)
+
+
+def reconstruct(enc, netG, unimgs, seed=0):
+    torch.manual_seed(seed)
+    last = cfg.TREE.BRANCH_NUM - 1
+    with torch.no_grad():
+        embedding = enc(unimgs)
+        z_code = torch.randn(unimgs.size(0), cfg.GAN.Z_DIM)
+        fake_imgs, _, _ = netG(z_code, embedding, out_stages=[last])
+    return fake_imgs[last]
+
+
+def encoder_batches(loader, num_batches):
+    from eval_fid import real_batches, encoder_input
+    batches = []
+    for unimgs, imgs in real_batches(loader):
+        if len(batches) == num_batches:
+            break
+        batches.append(encoder_input(imgs) if unimgs is None else unimgs)
+    return batches
+
+
+def benchmark(enc, netG, batches, reference=None):
+    # latency at batch size 1 and throughput at the loader batch size
+    single = batches[0][:1]
+    reconstruct(enc, netG, single)
+    start = time.perf_counter()
+    for _ in range(10):
+        reconstruct(enc, netG, single)
+    latency = 100.0 * (time.perf_counter() - start)
+    outs, num_images = [], 0
+    start = time.perf_counter()
+    for unimgs in batches:
+        outs.append(reconstruct(enc, netG, unimgs))
+        num_images += unimgs.size(0)
+    row = {'latency_ms': latency,
+           'images_per_sec': num_images / (time.perf_counter() - start)}
+    if reference is not None:
+        err = [(a - b).pow(2).mean().item() for a, b in zip(outs, reference)]
+        row['recon_mse_vs_fp32'] = sum(err) / len(err)
+    return row, outs
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = False
+    torch.backends.quantized.engine = args.engine
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    from serve import load_models
+    from eval_fid import make_dataset
+    enc, netG = load_models(args.net_g, args.net_e, torch.device('cpu'))
+
+    def loader(split):
+        dataset, _ = make_dataset(split)
+        return torch.utils.data.DataLoader(
+            dataset, batch_size=args.batch_size, shuffle=False,
+            num_workers=int(cfg.WORKERS))
+    eval_batches = encoder_batches(loader('test'), args.eval_batches)
+
+    report = {}
+    report['fp32'], reference = benchmark(enc, netG, eval_batches)
+    if args.mode == 'dynamic':
+        qenc = quantize_linear(copy.deepcopy(enc))
+        qnetG = quantize_linear(copy.deepcopy(netG))
+    else:
+        qconfig = get_default_qconfig(args.engine)
+        qenc = prepare_static_encoder(copy.deepcopy(enc), qconfig)
+        qnetG = prepare_static_generator(copy.deepcopy(netG), qconfig)
+        # observers record the activation ranges on training images
+        for unimgs in encoder_batches(loader('train'), args.calib_batches):
+            reconstruct(qenc, qnetG, unimgs)
+        qenc.res = convert(qenc.res)
+        qnetG = convert(qnetG)
+    report['int8_' + args.mode], _ = \
+        benchmark(qenc.eval(), qnetG.eval(), eval_batches, reference)
+
+    for name, row in report.items():
+        print('%-14s %8.1f ms/img (bs 1) %8.1f img/s  mse %s' %
+              (name, row['latency_ms'], row['images_per_sec'],
+               '%.3g' % row['recon_mse_vs_fp32']
+               if 'recon_mse_vs_fp32' in row else '-'))
+    if args.out != '':
+        # whole modules: the quantized layers have no fp32 state_dict
+        torch.save({'enc': qenc, 'netG': qnetG, 'mode': args.mode,
+                    'engine': args.engine}, args.out)
+    if args.json != '':
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,281 @@
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+dir_path = (os.path.abspath(os.path.join(os.path.realpath(__file__), './.')))
+sys.path.append(dir_path)
+
+from miscc.config import cfg, cfg_from_file
+
+# Reconstruction service: POST an image to /reconstruct?stage=<i> and get
+# back the PNG that encoder_resnet + G_NET make of it (only the stages and
+# image heads the batch needs are run). Concurrent requests
+# are run as one batch of up to --max_batch images; a batch waits at most
+# --max_wait_ms for more requests after its first one. GET /metrics
+# returns the queue depth, batch sizes and latency percentiles.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Reconstruction server')
+    parser.add_argument('--cfg', dest='cfg_file', type=str,
+                        default='cfg/birds_3stages.yml')
+    parser.add_argument('--gpu', dest='gpu_id', type=str, default='-1')
+    parser.add_argument('--net_g', type=str, required=True,
+                        help='netG_*.pth or an export_inference.py artifact')
+    parser.add_argument('--net_e', type=str, default='',
+                        help='encG_*.pth, next to netG_*.pth by default')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch', type=int, default=16)
+    parser.add_argument('--max_wait_ms', type=float, default=10.0)
+    parser.add_argument('--max_queue', type=int, default=256)
+    return parser.parse_args()
+
+
+def load_models(net_g, net_e, device):
+    from model1 import G_NET, encoder_resnet
+    from inference import load_generator, load_training_state
+    state = torch.load(net_g, map_location='cpu')
+    if 'version' in state:
+        netG = load_generator(net_g)
+    else:
+        netG = G_NET()
+        netG.load_state_dict(load_training_state(net_g))
+    assert isinstance(netG, G_NET), 'the server runs G_NET artifacts only'
+    if net_e == '':
+        head, tail = os.path.split(net_g)
+        net_e = os.path.join(head, tail.replace('netG_', 'encG_'))
+    enc = encoder_resnet(pretrained=False)
+    enc.load_state_dict(torch.load(net_e, map_location='cpu')['state_dict'])
+    return enc.to(device).eval(), netG.to(device).eval()
+
+
+class Request(object):
+    def __init__(self, image, stage):
+        self.image = image
+        self.stage = stage
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Metrics(object):
+    # counters and the latencies of the last `window` requests
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batched_images = 0
+        self.queue_ms = collections.deque(maxlen=window)
+        self.total_ms = collections.deque(maxlen=window)
+
+    def record_batch(self, requests, start):
+        now = time.perf_counter()
+        with self.lock:
+            self.batches += 1
+            self.batched_images += len(requests)
+            for req in requests:
+                self.queue_ms.append(1000.0 * (start - req.arrival))
+                self.total_ms.append(1000.0 * (now - req.arrival))
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self, queue_depth):
+        def percentiles(values):
+            values = sorted(values)
+            if not values:
+                return {}
+            return dict(('p%d' % p, values[min(len(values) - 1,
+                                               len(values) * p // 100)])
+                        for p in (50, 95, 99))
+        with self.lock:
+            return {'queue_depth': queue_depth,
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'rejected': self.rejected,
+                    'batches': self.batches,
+                    'mean_batch_size':
+                        self.batched_images / max(self.batches, 1),
+                    'queue_ms': percentiles(self.queue_ms),
+                    'latency_ms': percentiles(self.total_ms)}
+
+
+class Batcher(object):
+    """Collect requests into batches and run them on one worker thread."""
+    def __init__(self, enc, netG, device, max_batch, max_wait_ms, max_queue):
+        self.enc = enc
+        self.netG = netG
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue(max_queue)
+        self.metrics = Metrics()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, image, stage):
+        req = Request(image, stage)
+        self.queue.put_nowait(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            start = time.perf_counter()
+            try:
+                results = self.infer(batch)
+                for req, result in zip(batch, results):
+                    req.result = result
+            except Exception as e:
+                for req in batch:
+                    req.error = e
+            self.metrics.record_batch(batch, start)
+            for req in batch:
+                req.done.set()
+
+    def infer(self, batch):
+        images = torch.stack([req.image for req in batch]).to(self.device)
+        out_stages = set(req.stage for req in batch)
+        with torch.no_grad():
+            embedding = self.enc(images)
+            z_code = torch.randn(len(batch), cfg.GAN.Z_DIM,
+                                 device=self.device)
+            fake_imgs, _, _ = self.netG(z_code, embedding,
+                                        out_stages=out_stages)
+        return [fake_imgs[req.stage][i].cpu() for i, req in enumerate(batch)]
+
+
+# same input as ureal_imgs in training: 224 x 224, ImageNet statistics
+preprocess = transforms.Compose([
+    transforms.Resize(224),
+    transforms.CenterCrop(224),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                         std=[0.229, 0.224, 0.225])])
+
+
+def to_png(img):
+    # [-1, 1] C x H x W --> PNG bytes
+    img = img.add(1).mul(127.5).clamp(0, 255).byte()
+    buf = io.BytesIO()
+    Image.fromarray(img.permute(1, 2, 0).numpy()).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, code, obj):
+            self.send(code, json.dumps(obj).encode('utf-8'))
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/metrics':
+                self.send_json(200, batcher.metrics.snapshot(
+                    batcher.queue.qsize()))
+            elif path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/reconstruct':
+                self.send_json(404, {'error': 'not found'})
+                return
+            batcher.metrics.count('requests')
+            try:
+                query = parse_qs(url.query)
+                stage = int(query.get('stage', [cfg.TREE.BRANCH_NUM - 1])[0])
+                if not 0 <= stage < cfg.TREE.BRANCH_NUM:
+                    raise ValueError('stage must be in [0, %d)' %
+                                     cfg.TREE.BRANCH_NUM)
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                image = preprocess(Image.open(io.BytesIO(body)).convert('RGB'))
+            except Exception as e:
+                batcher.metrics.count('errors')
+                self.send_json(400, {'error': str(e)})
+                return
+            try:
+                result = batcher.submit(image, stage)
+            except queue.Full:
+                batcher.metrics.count('rejected')
+                self.send_json(503, {'error': 'queue full'})
+                return
+            except Exception as e:
+                batcher.metrics.count('errors')
+                self.send_json(500, {'error': str(e)})
+                return
+            self.send(200, to_png(result), 'image/png')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cfg_from_file(args.cfg_file)
+    cfg.CUDA = args.gpu_id != '-1'
+    device = torch.device('cuda:%s' % args.gpu_id if cfg.CUDA else 'cpu')
+    if cfg.CUDA:
+        torch.cuda.set_device(device)
+        torch.backends.cudnn.benchmark = True
+
+    enc, netG = load_models(args.net_g, args.net_e, device)
+    batcher = Batcher(enc, netG, device, args.max_batch, args.max_wait_ms,
+                      args.max_queue)
+    server = ThreadingHTTPServer((args.host, args.port),
+                                 make_handler(batcher))
+    print('Serving on http://%s:%d (max batch %d, max wait %.1f ms)' %
+          (args.host, args.port, args.max_batch, args.max_wait_ms))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -4,7 +4,9 @@ from six.moves import range
 import torch.backends.cudnn as cudnn
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.nn.parallel import DistributedDataParallel
 import torch.optim as optim
 import torchvision.utils as vutils
 import numpy as np
@@ -12,15 +14,19 @@ import os
 import time
 from PIL import Image, ImageFont, ImageDraw
 from copy import deepcopy
+from contextlib import ExitStack
 
 from miscc.config import cfg
-from miscc.utils import mkdir_p
+from miscc.utils import mkdir_p, is_main_process, get_rank, ImageWriter
+from miscc.timer import StepTimer
+from miscc.profiler import StepProfiler
 
 from tensorboardX import summary
 from tensorboardX import FileWriter
 from torchvision import models
 
 from model1 import  G_NET, encoder_resnet, encoder_resnet1, G_NET1, D_NET64, D_NET128, D_NET256, D_NET512, D_NET1024, INCEPTION_V3
+from model1 import frozen_bn_stats
 
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -29,23 +35,57 @@ finetuned = None
 def compute_mean_covariance(img):
     batch_size = img.size(0)
     channel_num = img.size(1)
-    height = img.size(2)
-    width = img.size(3)
-    num_pixels = height * width
-
-    # batch_size * channel_num * 1 * 1
-    mu = img.mean(2, keepdim=True).mean(3, keepdim=True)
+    num_pixels = img.size(2) * img.size(3)
 
     # batch_size * channel_num * num_pixels
-    img_hat = img - mu.expand_as(img)
-    img_hat = img_hat.view(batch_size, channel_num, num_pixels)
-    # batch_size * num_pixels * channel_num
-    img_hat_transpose = img_hat.transpose(1, 2)
-    # batch_size * channel_num * channel_num
-    covariance = torch.bmm(img_hat, img_hat_transpose)
-    covariance = covariance / num_pixels
+    img = img.reshape(batch_size, channel_num, num_pixels)
+    # batch_size * channel_num
+    mu = img.mean(2)
+    # E[x x^T] - mu mu^T in one batched matmul, without a centered copy
+    mu_outer = torch.bmm(mu.unsqueeze(2), mu.unsqueeze(1))
+    covariance = torch.baddbmm(mu_outer, img, img.transpose(1, 2),
+                               beta=-1, alpha=1.0 / num_pixels)
+
+    return mu.view(batch_size, channel_num, 1, 1), covariance
+
 
-    return mu, covariance
+class ColorConsistencyLoss(nn.Module):
+    """Match the color mean and covariance of consecutive stages.
+
+    The last stage follows the one before it, that one follows the one
+    before it and, with three or more stages, the lowest of the three
+    follows the real image. The statistics of each image are computed
+    once and the detached targets reuse them. Returns the total and the
+    individual terms by summary name.
+    """
+    def __init__(self, coeff, cov_weight=5.0):
+        super(ColorConsistencyLoss, self).__init__()
+        self.coeff = coeff
+        self.cov_weight = cov_weight
+
+    def pair_loss(self, stats1, stats2):
+        like_mu = self.coeff * F.mse_loss(stats1[0], stats2[0])
+        like_cov = self.coeff * self.cov_weight * \
+            F.mse_loss(stats1[1], stats2[1])
+        return like_mu, like_cov
+
+    def forward(self, fake_imgs, real_img):
+        terms = {}
+        num_imgs = len(fake_imgs)
+        if self.coeff <= 0 or num_imgs < 2:
+            return 0, terms
+        stats = [compute_mean_covariance(img) for img in fake_imgs[-3:]]
+        detached = [(mu.detach(), cov.detach()) for mu, cov in stats]
+        terms['G_like_mu2'], terms['G_like_cov2'] = \
+            self.pair_loss(stats[-1], detached[-2])
+        if num_imgs > 2:
+            with torch.no_grad():
+                real_stats = compute_mean_covariance(real_img)
+            terms['G_like_mu0'], terms['G_like_cov0'] = \
+                self.pair_loss(stats[-3], real_stats)
+            terms['G_like_mu1'], terms['G_like_cov1'] = \
+                self.pair_loss(stats[-2], detached[-3])
+        return sum(terms.values()), terms
 
 
 def KL_loss(mu, logvar):
@@ -68,6 +108,80 @@ def weights_init(m):
             m.bias.data.fill_(0.0)
 
 
+def parallelize(net, gpus):
+    if cfg.DIST.FLAG:
+        # Some parameters get no gradient in a step when inactive stages are
+        # skipped (progressive training) or when the D uncond_logits head is
+        # left out of the losses (UNCOND_LOSS 0)
+        find_unused = cfg.TRAIN.PROGRESSIVE.FLAG or \
+            cfg.TRAIN.COEFF.UNCOND_LOSS == 0
+        # one device per process; modules must be placed before wrapping
+        if cfg.CUDA:
+            net = net.cuda()
+            return DistributedDataParallel(
+                net, device_ids=gpus, output_device=gpus[0],
+                find_unused_parameters=find_unused)
+        return DistributedDataParallel(
+            net, find_unused_parameters=find_unused)
+    return torch.nn.DataParallel(net, device_ids=gpus)
+
+
+def compile_network(net, gpus):
+    # Compile in place so that state_dict keys stay the same. DataParallel
+    # replicas would share the compiled call of the original module, so
+    # only single-device and DDP models are compiled.
+    if not cfg.TRAIN.COMPILE.FLAG:
+        return net
+    if isinstance(net, torch.nn.DataParallel) and len(gpus) > 1:
+        print('TRAIN.COMPILE: skipping %s under multi-GPU DataParallel' %
+              net.module.__class__.__name__)
+        return net
+    inner = net.module if hasattr(net, 'module') else net
+    inner.compile(mode=cfg.TRAIN.COMPILE.MODE)
+    return net
+
+
+def unwrap(net):
+    if isinstance(net, DistributedDataParallel):
+        return net.module
+    return net
+
+
+def no_sync(nets, enabled=True):
+    # Skip the DDP gradient all-reduce for all but the last micro-batch
+    stack = ExitStack()
+    if enabled:
+        for net in nets:
+            if isinstance(net, DistributedDataParallel):
+                stack.enter_context(net.no_sync())
+    return stack
+
+
+def get_rng_state():
+    state = [torch.get_rng_state()]
+    if cfg.CUDA:
+        state.append(torch.cuda.get_rng_state_all())
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state[0])
+    if cfg.CUDA:
+        torch.cuda.set_rng_state_all(state[1])
+
+
+class NullWriter(object):
+    # Summary writer for the non-zero ranks of a distributed run
+    def add_summary(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
 def load_params(model, new_param):
     for p, new_p in zip(model.parameters(), new_param):
         p.data.copy_(new_p)
@@ -115,8 +229,9 @@ def load_network(gpus, path):
     netG = G_NET()
     #netG = G_NET1()
     netG.apply(weights_init)
-    netG = torch.nn.DataParallel(netG, device_ids=gpus)
-    print(netG)
+    netG = parallelize(netG, gpus)
+    if is_main_process():
+        print(netG)
     #enc = models.resnet50(pretrained=True)
     #for param in enc.parameters():
      #       param.requires_grad = False
@@ -147,7 +262,7 @@ def load_network(gpus, path):
 
     for i in range(len(netsD)):
         netsD[i].apply(weights_init)
-        netsD[i] = torch.nn.DataParallel(netsD[i], device_ids=gpus)
+        netsD[i] = parallelize(netsD[i], gpus)
         # print(netsD[i])
     print('# of netsD', len(netsD))
 
@@ -178,17 +293,30 @@ def load_network(gpus, path):
             checkpoint = torch.load(Dpath)
             netsD[i].load_state_dict(checkpoint['state_dict'])
 
-    inception_model = INCEPTION_V3()
+    if cfg.DIST.FLAG:
+        # wrapped after loading so that encG_*.pth keeps its keys
+        enc = parallelize(enc, gpus)
 
     if cfg.CUDA:
         enc.cuda()
         netG.cuda()
         for i in range(len(netsD)):
             netsD[i].cuda()
-        inception_model = inception_model.cuda()
-    inception_model.eval()
 
-    return enc, netG, netsD, len(netsD), inception_model, count
+    enc = compile_network(enc, gpus)
+    netG = compile_network(netG, gpus)
+    for i in range(len(netsD)):
+        netsD[i] = compile_network(netsD[i], gpus)
+
+    return enc, netG, netsD, len(netsD), count
+
+
+def load_inception():
+    # built on first use, so runs without inception score never load it
+    inception_model = INCEPTION_V3()
+    if cfg.CUDA:
+        inception_model = inception_model.cuda()
+    return inception_model.eval()
 
 def optimizerToDevice(optimizer):
     for state in optimizer.state.values():
@@ -242,7 +370,7 @@ def save_model(enc, avg_param_E, netG, optimizerG, avg_param_G, netsD, optimizer
     #load_params(netG, avg_param_G)
     #load_params(enc, avg_param_E)
     
-    stateE = {'state_dict': enc.state_dict(),
+    stateE = {'state_dict': unwrap(enc).state_dict(),
              'optimizer': optimizerG.state_dict()}
     
     torch.save(
@@ -310,23 +438,33 @@ def save_img_results(imgs_tcpu, fake_imgs, num_imgs,
 # ################# Text to image task############################ #
 class condGANTrainer(object):
     def __init__(self, output_dir, data_loader, imsize):
+        # checkpoints, images and summaries are only written by rank 0
+        self.is_main = is_main_process()
         if cfg.TRAIN.FLAG:
             self.model_dir = os.path.join(output_dir, 'Model')
             self.image_dir = os.path.join(output_dir, 'Image')
             self.log_dir = os.path.join(output_dir, 'Log')
-            mkdir_p(self.model_dir)
-            mkdir_p(self.image_dir)
-            mkdir_p(self.log_dir)
-            self.summary_writer = FileWriter(self.log_dir)
+            if self.is_main:
+                mkdir_p(self.model_dir)
+                mkdir_p(self.image_dir)
+                mkdir_p(self.log_dir)
+                self.summary_writer = FileWriter(self.log_dir)
+            else:
+                self.summary_writer = NullWriter()
 
         s_gpus = cfg.GPU_ID.split(',')
         self.gpus = [int(ix) for ix in s_gpus]
         self.num_gpus = len(self.gpus)
-        torch.cuda.set_device(self.gpus[0])
+        if cfg.CUDA:
+            torch.cuda.set_device(self.gpus[0])
         cudnn.benchmark = True
 
         self.batch_size = cfg.TRAIN.BATCH_SIZE * self.num_gpus
+        self.micro_batch = cfg.TRAIN.MICRO_BATCH
+        if self.micro_batch >= self.batch_size:
+            self.micro_batch = 0
         self.max_epoch = cfg.TRAIN.MAX_EPOCH
+        self.max_steps = cfg.TRAIN.MAX_STEPS
         self.snapshot_interval = cfg.TRAIN.SNAPSHOT_INTERVAL
 
         self.data_loader = data_loader
@@ -340,7 +478,8 @@ class condGANTrainer(object):
             vembedding = Variable(t_embedding).cuda()
         else:
             vembedding = Variable(t_embedding)
-        for i in range(self.num_Ds):
+        # only the pyramid levels of the active stages are in the batch
+        for i in range(len(imgs)):
             if cfg.CUDA:
                 real_vimgs.append(Variable(imgs[i]).cuda())
                 wrong_vimgs.append(Variable(w_imgs[i]).cuda())
@@ -348,20 +487,17 @@ class condGANTrainer(object):
             else:
                 real_vimgs.append(Variable(imgs[i]))
                 wrong_vimgs.append(Variable(w_imgs[i]))
-                ureal_vimgs.append(Variable(uimgs[i]).cuda())
+                ureal_vimgs.append(Variable(uimgs[i]))
         return imgs, ureal_vimgs, real_vimgs, wrong_vimgs, vembedding
 
-    def train_Dnet(self, idx, count):
-        flag = count % 100
+    def compute_Dnet_loss(self, idx):
         batch_size = self.real_imgs[0].size(0)
         criterion, mu = self.criterion, self.mu
 
-        netD, optD = self.netsD[idx], self.optimizersD[idx]
+        netD = self.netsD[idx]
         real_imgs = self.real_imgs[idx]
         wrong_imgs = self.wrong_imgs[idx]
         fake_imgs = self.fake_imgs[idx]
-        #
-        netD.zero_grad()
         # Forward
         real_labels = self.real_labels[:batch_size]
         fake_labels = self.fake_labels[:batch_size]
@@ -388,6 +524,13 @@ class condGANTrainer(object):
             errD = errD_real + errD_wrong + errD_fake
         else:
             errD = errD_real + 0.5 * (errD_wrong + errD_fake)
+        return errD
+
+    def train_Dnet(self, idx, count):
+        flag = count % 100
+        netD, optD = self.netsD[idx], self.optimizersD[idx]
+        netD.zero_grad()
+        errD = self.compute_Dnet_loss(idx)
         # backward
         errD.backward()
         torch.nn.utils.clip_grad_norm_(netD.parameters(), 5.00)
@@ -399,17 +542,15 @@ class condGANTrainer(object):
             self.summary_writer.add_summary(summary_D, count)
         return errD
 
-    def train_Gnet(self, count):
-        self.enc.zero_grad()
-        self.netG.zero_grad()
+    def compute_Gnet_loss(self, count, log=True):
         errG_total = 0
         #errM_total = 0
-        flag = count % 100
+        flag = count % 100 if log else 1
         batch_size = self.real_imgs[0].size(0)
         criterion, mu, logvar = self.criterion, self.mu, self.logvar
         criterion1 = self.criterion1
         real_labels = self.real_labels[:batch_size]
-        for i in range(self.num_Ds):
+        for i in range(len(self.fake_imgs)):
             outputs = self.netsD[i](self.fake_imgs[i], mu)
             errG = criterion(outputs[0], real_labels)
             #errM = criterion1(self.fake_imgs[i], self.real_imgs[i])
@@ -424,71 +565,157 @@ class condGANTrainer(object):
                 self.summary_writer.add_summary(summary_D, count)
 
         # Compute color consistency losses
-        if cfg.TRAIN.COEFF.COLOR_LOSS > 0:
-            if self.num_Ds > 1:
-                mu1, covariance1 = compute_mean_covariance(self.fake_imgs[-1])
-                mu2, covariance2 = \
-                    compute_mean_covariance(self.fake_imgs[-2].detach())
-                mu1 = mu1.to(device)
-                covariance1 = covariance1.to(device)
-                mu2 = mu2.to(device)
-                covariance2 = covariance2.to(device)
-                like_mu2 = cfg.TRAIN.COEFF.COLOR_LOSS * criterion1(mu1, mu2)
-                like_cov2 = cfg.TRAIN.COEFF.COLOR_LOSS * 5 * \
-                    criterion1(covariance1, covariance2)
-                errG_total = errG_total + like_mu2 + like_cov2
-                if flag == 0:
-                    sum_mu = summary.scalar('G_like_mu2', like_mu2.item())
-                    self.summary_writer.add_summary(sum_mu, count)
-                    sum_cov = summary.scalar('G_like_cov2', like_cov2.item())
-                    self.summary_writer.add_summary(sum_cov, count)
-            if self.num_Ds > 2:
-                mu1, covariance1 = compute_mean_covariance(self.fake_imgs[-3])
-                mu2, covariance2 = \
-                    compute_mean_covariance(self.real_imgs[0])
-                mu1 = mu1.to(device)
-                covariance1 = covariance1.to(device)
-                mu2 = mu2.to(device)
-                covariance2 = covariance2.to(device)
-                like_mu0 = cfg.TRAIN.COEFF.COLOR_LOSS * criterion1(mu1, mu2)
-                like_cov0 = cfg.TRAIN.COEFF.COLOR_LOSS * 5 * \
-                    criterion1(covariance1, covariance2)
-                mu1, covariance1 = compute_mean_covariance(self.fake_imgs[-2])
-                mu2, covariance2 = \
-                    compute_mean_covariance(self.fake_imgs[-3].detach())
-                mu1 = mu1.to(device)
-                covariance1 = covariance1.to(device)
-                mu2 = mu2.to(device)
-                covariance2 = covariance2.to(device)
-                like_mu1 = cfg.TRAIN.COEFF.COLOR_LOSS * criterion1(mu1, mu2)
-                like_cov1 = cfg.TRAIN.COEFF.COLOR_LOSS * 5 * \
-                    criterion1(covariance1, covariance2)
-                errG_total = errG_total + like_mu1 + like_cov1 + like_mu0 + like_cov0
-                if flag == 0:
-                    sum_mu = summary.scalar('G_like_mu1', like_mu1.item())
-                    self.summary_writer.add_summary(sum_mu, count)
-                    sum_cov = summary.scalar('G_like_cov1', like_cov1.item())
-                    self.summary_writer.add_summary(sum_cov, count)
+        with self.timer.phase('color_loss'):
+            errG_total = errG_total + self.compute_color_loss(flag, count)
 
         kl_loss = KL_loss(mu, logvar) * cfg.TRAIN.COEFF.KL
         errG_total = errG_total + kl_loss #+ errM_total
+        return errG_total, kl_loss
+
+    def train_Gnet(self, count):
+        self.enc.zero_grad()
+        self.netG.zero_grad()
+        errG_total, kl_loss = self.compute_Gnet_loss(count)
         errG_total.backward()
         torch.nn.utils.clip_grad_norm_(self.enc.parameters(), 5.00)
         torch.nn.utils.clip_grad_norm_(self.netG.parameters(), 5.00)
         self.optimizerG.step()
         return kl_loss, errG_total- kl_loss#, errM_total
 
+    def train_accumulated(self, noise, count):
+        """One training step over micro-batches of self.micro_batch images.
+
+        Gradients of each chunk are scaled by its share of the batch and
+        accumulated, so clipping and the optimizer steps see the gradient
+        of the whole batch. BatchNorm uses the statistics of each chunk.
+        The fake images for the D updates are made without a graph and
+        without updating running statistics. The G update re-runs the
+        encoder and G on every chunk with the same RNG state, so it sees
+        the same fake images.
+        """
+        timer = self.timer
+        flag = count % 100
+        ureal_imgs, real_imgs, wrong_imgs = \
+            self.ureal_imgs, self.real_imgs, self.wrong_imgs
+        batch_size = real_imgs[0].size(0)
+        chunks = [slice(start, min(start + self.micro_batch, batch_size))
+                  for start in range(0, batch_size, self.micro_batch)]
+        weights = [float(sl.stop - sl.start) / batch_size for sl in chunks]
+
+        def select(sl):
+            self.ureal_imgs = [img[sl] for img in ureal_imgs]
+            self.real_imgs = [img[sl] for img in real_imgs]
+            self.wrong_imgs = [img[sl] for img in wrong_imgs]
+
+        rng_state = get_rng_state()
+        fake_chunks, mu_chunks, emb_chunks = [], [], []
+        with timer.phase('G_forward'):
+            with torch.no_grad(), frozen_bn_stats(self.enc, self.netG):
+                for sl in chunks:
+                    emb = self.enc(ureal_imgs[0][sl])
+                    fake_imgs, mu, _ = \
+                        self.netG(noise[sl], emb, self.num_active)
+                    fake_chunks.append(fake_imgs)
+                    mu_chunks.append(mu)
+                    emb_chunks.append(emb)
+
+        errD_total = 0
+        for i in range(self.num_active):
+            if not self.D_update_due(i, count):
+                continue
+            with timer.phase('D%d' % i):
+                netD, optD = self.netsD[i], self.optimizersD[i]
+                netD.zero_grad()
+                errD = 0
+                for k, sl in enumerate(chunks):
+                    select(sl)
+                    self.fake_imgs, self.mu = fake_chunks[k], mu_chunks[k]
+                    with no_sync([netD], k < len(chunks) - 1):
+                        loss = weights[k] * self.compute_Dnet_loss(i)
+                        loss.backward()
+                    errD = errD + loss.detach()
+                torch.nn.utils.clip_grad_norm_(netD.parameters(), 5.00)
+                optD.step()
+                if flag == 0:
+                    summary_D = summary.scalar('D_loss%d' % i, errD.item())
+                    self.summary_writer.add_summary(summary_D, count)
+            errD_total += errD
+
+        with timer.phase('G_update'):
+            set_rng_state(rng_state)
+            self.enc.zero_grad()
+            self.netG.zero_grad()
+            errG_total, kl_loss = 0, 0
+            nets = [self.enc, self.netG] + self.netsD
+            for k, sl in enumerate(chunks):
+                select(sl)
+                with no_sync(nets, k < len(chunks) - 1):
+                    emb = self.enc(self.ureal_imgs[0])
+                    self.fake_imgs, self.mu, self.logvar = \
+                        self.netG(noise[sl], emb, self.num_active)
+                    errG, kl = self.compute_Gnet_loss(count, log=k == 0)
+                    (weights[k] * errG).backward()
+                errG_total = errG_total + weights[k] * errG.detach()
+                kl_loss = kl_loss + weights[k] * kl.detach()
+            torch.nn.utils.clip_grad_norm_(self.enc.parameters(), 5.00)
+            torch.nn.utils.clip_grad_norm_(self.netG.parameters(), 5.00)
+            self.optimizerG.step()
+
+        # full-batch views for the inception score and the snapshots
+        self.ureal_imgs, self.real_imgs, self.wrong_imgs = \
+            ureal_imgs, real_imgs, wrong_imgs
+        self.fake_imgs = [torch.cat([f[j] for f in fake_chunks], 0)
+                          for j in range(len(fake_chunks[0]))]
+        self.txt_embedding = torch.cat(emb_chunks, 0)
+        return errD_total, kl_loss, errG_total - kl_loss
+
+    def compute_color_loss(self, flag, count):
+        errG_total, terms = self.color_loss(self.fake_imgs, self.real_imgs[0])
+        if flag == 0:
+            # the terms against the real image are not logged
+            for name in ('G_like_mu2', 'G_like_cov2',
+                         'G_like_mu1', 'G_like_cov1'):
+                if name in terms:
+                    summ = summary.scalar(name, terms[name].item())
+                    self.summary_writer.add_summary(summ, count)
+        return errG_total
+
+    def D_update_due(self, idx, count):
+        # D_idx is updated every TRAIN.D_UPDATE_INTERVAL[idx] steps; skipped
+        # steps run no D forward and leave its optimizer untouched
+        intervals = cfg.TRAIN.D_UPDATE_INTERVAL
+        if idx < len(intervals) and intervals[idx] > 1:
+            return count % intervals[idx] == 0
+        return True
+
+    def scheduled_stages(self, count):
+        # number of stages trained at step `count`
+        if not cfg.TRAIN.PROGRESSIVE.FLAG:
+            return self.num_Ds
+        num_stages = 1
+        for start in cfg.TRAIN.PROGRESSIVE.STAGE_STEPS:
+            if count >= start:
+                num_stages += 1
+        return min(num_stages, self.num_Ds)
+
     def train(self):
-        self.enc, self.netG, self.netsD, self.num_Ds,\
-            self.inception_model, start_count = load_network(self.gpus, self.model_dir)
+        self.enc, self.netG, self.netsD, self.num_Ds, start_count = \
+            load_network(self.gpus, self.model_dir)
+        # inception score is only computed on the main process
+        self.inception_model = None
+        use_inception = cfg.TRAIN.INCEPTION_SCORE and self.is_main
         avg_param_G = copy_G_params(self.netG)
         avg_param_E = copy_G_params(self.enc)
 
         self.optimizerG, self.optimizersD = \
             define_optimizers(self.enc, self.netG, self.netsD, self.model_dir)
 
-        self.criterion = nn.BCELoss()
+        if cfg.GAN.D_LOGITS:
+            self.criterion = nn.BCEWithLogitsLoss()
+        else:
+            self.criterion = nn.BCELoss()
         self.criterion1 = nn.MSELoss()
+        self.color_loss = ColorConsistencyLoss(cfg.TRAIN.COEFF.COLOR_LOSS)
 
         self.real_labels = \
             Variable(torch.FloatTensor(self.batch_size).fill_(1))
@@ -511,57 +738,113 @@ class condGANTrainer(object):
             self.gradient_half = self.gradient_half.cuda()
             noise, fixed_noise = noise.cuda(), fixed_noise.cuda()
 
+        profile_name = 'train' if self.is_main else 'train_rank%d' % get_rank()
+        profiler = StepProfiler(self.log_dir, profile_name,
+                                [self.enc, self.netG] + self.netsD)
+        # color_loss is a sub-phase of G_update
+        phases = ['data_wait', 'prepare_data', 'encoder', 'G_forward'] + \
+            ['D%d' % i for i in range(self.num_Ds)] + \
+            ['G_update', 'color_loss', 'ema', 'inception', 'checkpoint']
+        d_schedule = ':'.join(
+            str(max(cfg.TRAIN.D_UPDATE_INTERVAL[i], 1))
+            if i < len(cfg.TRAIN.D_UPDATE_INTERVAL) else '1'
+            for i in range(self.num_Ds))
+        if self.is_main:
+            print('D update intervals', d_schedule)
+        timer = StepTimer(phases, enabled=cfg.TRAIN.TIMING.FLAG,
+                          sync=cfg.TRAIN.TIMING.SYNC and cfg.CUDA,
+                          interval=cfg.TRAIN.TIMING.INTERVAL,
+                          starve_ms=cfg.TRAIN.TIMING.STARVE_MS,
+                          csv_path=os.path.join(self.log_dir, 'timing.csv')
+                          if self.is_main else None,
+                          summary_writer=self.summary_writer,
+                          record_functions=profiler.enabled,
+                          tags={'d_schedule': d_schedule})
+        self.timer = timer
+        profiler.start()
+
         predictions = []
         count = start_count
         start_epoch = start_count // (self.num_batches)
         for epoch in range(start_epoch, self.max_epoch):
             start_t = time.time()
-
+            if hasattr(self.data_loader.sampler, 'set_epoch'):
+                self.data_loader.sampler.set_epoch(epoch)
+            # workers copy the dataset when the epoch starts, so load the
+            # levels needed by the end of this epoch
+            dataset = self.data_loader.dataset
+            if hasattr(dataset, 'num_levels'):
+                dataset.num_levels = \
+                    self.scheduled_stages(count + self.num_batches - 1)
+
+            timer.mark()
             for step, data in enumerate(self.data_loader, 0):
+                timer.data_ready()
                 #######################################################
                 # (0) Prepare training data
                 ######################################################
-                self.imgs_tcpu, self.ureal_imgs, self.real_imgs, self.wrong_imgs, \
-                    self.txt_embedd = self.prepare_data(data)
-                self.txt_embedding = self.enc(self.ureal_imgs[0])
-                #self.txt_embedding, self.mu, self.logvar = self.enc(self.ureal_imgs[0])
-                #print(torch.max(torch.abs(self.txt_embedding)))
-
-                #######################################################
-                # (1) Generate fake images
-                ######################################################
-                noise.data.normal_(0, 1)
-                #self.fake_imgs, self.mu, self.logvar = \
-                 #   self.netG(noise, self.txt_embedding.detach())
-                self.fake_imgs, self.mu, self.logvar = \
-                    self.netG(noise, self.txt_embedding)
-                #self.fake_imgs= self.netG(noise, self.txt_embedding)
-
-
-                #######################################################
-                # (2) Update D network
-                ######################################################
-                errD_total = 0
-                for i in range(self.num_Ds):
-                    errD = self.train_Dnet(i, count)
-                    errD_total += errD
-
-                #######################################################
-                # (3) Update G network: maximize log(D(G(z)))
-                ######################################################
-                #kl_loss, errG_total, errM_total = self.train_Gnet(count)
-                kl_loss, errG_total = self.train_Gnet(count)
-                for p, avg_p in zip(self.netG.parameters(), avg_param_G):
-                    avg_p.mul_(0.999).add_(0.001, p.data)
+                with timer.phase('prepare_data'):
+                    self.imgs_tcpu, self.ureal_imgs, self.real_imgs, \
+                        self.wrong_imgs, self.txt_embedd = \
+                        self.prepare_data(data)
+                self.num_active = min(self.scheduled_stages(count),
+                                      len(self.real_imgs))
+                if self.micro_batch > 0:
+                    noise.data.normal_(0, 1)
+                    errD_total, kl_loss, errG_total = \
+                        self.train_accumulated(noise, count)
+                else:
+                    with timer.phase('encoder'):
+                        self.txt_embedding = self.enc(self.ureal_imgs[0])
+                    #self.txt_embedding, self.mu, self.logvar = self.enc(self.ureal_imgs[0])
+                    #print(torch.max(torch.abs(self.txt_embedding)))
+
+                    #######################################################
+                    # (1) Generate fake images
+                    ######################################################
+                    noise.data.normal_(0, 1)
+                    #self.fake_imgs, self.mu, self.logvar = \
+                     #   self.netG(noise, self.txt_embedding.detach())
+                    with timer.phase('G_forward'):
+                        self.fake_imgs, self.mu, self.logvar = \
+                            self.netG(noise, self.txt_embedding,
+                                      self.num_active)
+                    #self.fake_imgs= self.netG(noise, self.txt_embedding)
+
+
+                    #######################################################
+                    # (2) Update D network
+                    ######################################################
+                    errD_total = 0
+                    for i in range(self.num_active):
+                        if not self.D_update_due(i, count):
+                            continue
+                        with timer.phase('D%d' % i):
+                            errD = self.train_Dnet(i, count)
+                        errD_total += errD
+
+                    #######################################################
+                    # (3) Update G network: maximize log(D(G(z)))
+                    ######################################################
+                    #kl_loss, errG_total, errM_total = self.train_Gnet(count)
+                    with timer.phase('G_update'):
+                        kl_loss, errG_total = self.train_Gnet(count)
+                with timer.phase('ema'):
+                    for p, avg_p in zip(self.netG.parameters(), avg_param_G):
+                        avg_p.mul_(0.999).add_(0.001, p.data)
                 #for e, avg_e in zip(self.enc.parameters(), avg_param_E):
                  #   avg_e.mul_(0.999).add_(0.001, e.data)
 
-                # for inception score
-                pred = self.inception_model(self.fake_imgs[-1].detach())
-                predictions.append(pred.data.cpu().numpy())
+                # for inception score, once the last stage is trained
+                if use_inception and self.num_active == self.num_Ds:
+                    with timer.phase('inception'):
+                        if self.inception_model is None:
+                            self.inception_model = load_inception()
+                        pred = self.inception_model(self.fake_imgs[-1].detach())
+                        predictions.append(pred.data.cpu().numpy())
 
                 if count % 100 == 0:
-                    summary_D = summary.scalar('D_loss', errD_total.item())
+                    summary_D = summary.scalar('D_loss', float(errD_total))
                     summary_G = summary.scalar('G_loss', errG_total.item())
                     summary_KL = summary.scalar('KL_loss', kl_loss.item())
                     #summary_MSE = summary.scalar('MSE_loss', errM_total.item())
@@ -572,91 +855,68 @@ class condGANTrainer(object):
 
                 count = count + 1
 
-                if count % cfg.TRAIN.SNAPSHOT_INTERVAL == 0:
+                if count % cfg.TRAIN.SNAPSHOT_INTERVAL == 0 and self.is_main:
+                    with timer.phase('checkpoint'):
                 #if count % 2 == 0:
-                    save_model(self.enc, avg_param_E, self.netG, self.optimizerG, avg_param_G, self.netsD, self.optimizersD, count, self.model_dir)
-                    # Save images
-                    #backup_para = copy_G_params(self.netG)
-                    #backup_para_E = copy_G_params(self.enc)
-                    #load_params(self.netG, avg_param_G)
-                    #load_params(self.enc, avg_param_E)
-                    #
-                    self.fake_imgs, _, _ = \
-                        self.netG(fixed_noise, self.txt_embedding.detach())
-                    #self.fake_imgs = self.netG(fixed_noise, self.txt_embedding.detach())
-                    save_img_results(self.imgs_tcpu, self.fake_imgs, self.num_Ds,
-                                     count, self.image_dir, self.summary_writer)
-                    #
-                    #load_params(self.netG, backup_para)
-                    #load_params(self.enc, backup_para_E)
-
-                    # Compute inception score
-                    if len(predictions) > 500:
-                        predictions = np.concatenate(predictions, 0)
-                        mean, std = compute_inception_score(predictions, 10)
-                        # print('mean:', mean, 'std', std)
-                        m_incep = summary.scalar('Inception_mean', mean)
-                        self.summary_writer.add_summary(m_incep, count)
+                        save_model(self.enc, avg_param_E, self.netG, self.optimizerG, avg_param_G, self.netsD, self.optimizersD, count, self.model_dir)
+                        # Save images
+                        #backup_para = copy_G_params(self.netG)
+                        #backup_para_E = copy_G_params(self.enc)
+                        #load_params(self.netG, avg_param_G)
+                        #load_params(self.enc, avg_param_E)
                         #
-                        mean_nlpp, std_nlpp = \
-                            negative_log_posterior_probability(predictions, 10)
-                        m_nlpp = summary.scalar('NLPP_mean', mean_nlpp)
-                        self.summary_writer.add_summary(m_nlpp, count)
+                        # bypass DDP: its forward is a collective op
+                        with torch.no_grad():
+                            self.fake_imgs, _, _ = unwrap(self.netG)(
+                                fixed_noise, self.txt_embedding.detach(),
+                                self.num_active)
+                        #self.fake_imgs = self.netG(fixed_noise, self.txt_embedding.detach())
+                        save_img_results(self.imgs_tcpu, self.fake_imgs, self.num_active,
+                                         count, self.image_dir, self.summary_writer)
                         #
-                        predictions = []
+                        #load_params(self.netG, backup_para)
+                        #load_params(self.enc, backup_para_E)
+
+                        # Compute inception score
+                        if len(predictions) > 500:
+                            predictions = np.concatenate(predictions, 0)
+                            mean, std = compute_inception_score(predictions, 10)
+                            # print('mean:', mean, 'std', std)
+                            m_incep = summary.scalar('Inception_mean', mean)
+                            self.summary_writer.add_summary(m_incep, count)
+                            #
+                            mean_nlpp, std_nlpp = \
+                                negative_log_posterior_probability(predictions, 10)
+                            m_nlpp = summary.scalar('NLPP_mean', mean_nlpp)
+                            self.summary_writer.add_summary(m_nlpp, count)
+                            #
+                            predictions = []
+
+                timer.end_step(count, self.batch_size)
+                profiler.step()
+                if self.max_steps > 0 and count - start_count >= self.max_steps:
+                    break
 
             end_t = time.time()
+            if self.max_steps > 0 and count - start_count >= self.max_steps:
+                break
+            if not self.is_main:
+                continue
             print('''[%d/%d][%d]
-                         Loss_D: %.2f Loss_G: %.2f  Loss_KL: %.2f Time: %.2fs
+                         Loss_D: %.2f Loss_G: %.2f  Loss_KL: %.2f Time: %.2fs (%.1f img/s)
                       '''  # D(real): %.4f D(wrong):%.4f  D(fake) %.4f
                   % (epoch, self.max_epoch, self.num_batches,
-                     errD_total.item(), errG_total.item(),
-                     kl_loss.item(), end_t - start_t))
-
-        save_model(self.enc, avg_param_E, self.netG, self.optimizerG, avg_param_G, self.netsD, self.optimizersD, count, self.model_dir)
+                     float(errD_total), errG_total.item(),
+                     kl_loss.item(), end_t - start_t,
+                     self.num_batches * self.batch_size / (end_t - start_t)))
+
+        profiler.stop()
+        if self.is_main:
+            save_model(self.enc, avg_param_E, self.netG, self.optimizerG, avg_param_G, self.netsD, self.optimizersD, count, self.model_dir)
+        timer.flush(count)
+        timer.close()
         self.summary_writer.close()
 
-    def save_superimages(self, images_list, filenames,
-                         save_dir, split_dir, imsize):
-        batch_size = images_list[0].size(0)
-        num_sentences = len(images_list)
-        for i in range(batch_size):
-            s_tmp = '%s/super/%s/%s' %\
-                (save_dir, split_dir, filenames[i])
-            folder = s_tmp[:s_tmp.rfind('/')]
-            if not os.path.isdir(folder):
-                print('Make a new folder: ', folder)
-                mkdir_p(folder)
-            #
-            savename = '%s_%d.png' % (s_tmp, imsize)
-            super_img = []
-            for j in range(num_sentences):
-                img = images_list[j][i]
-                # print(img.size())
-                img = img.view(1, 3, imsize, imsize)
-                # print(img.size())
-                super_img.append(img)
-                # break
-            super_img = torch.cat(super_img, 0)
-            vutils.save_image(super_img, savename, nrow=10, normalize=True)
-
-    def save_singleimages(self, images, filenames,
-                          save_dir, split_dir, sentenceID, imsize):
-        for i in range(images.size(0)):
-            s_tmp = '%s/single_samples/%s/%s' %\
-                (save_dir, split_dir, filenames[i])
-            folder = s_tmp[:s_tmp.rfind('/')]
-            if not os.path.isdir(folder):
-                print('Make a new folder: ', folder)
-                mkdir_p(folder)
-
-            fullpath = '%s_%d_sentence%d.png' % (s_tmp, imsize, sentenceID)
-            # range from [-1, 1] to [0, 255]
-            img = images[i].add(1).div(2).mul(255).clamp(0, 255).byte()
-            ndarr = img.permute(1, 2, 0).data.cpu().numpy()
-            im = Image.fromarray(ndarr)
-            im.save(fullpath)
-
     def evaluate(self, split_dir):
         if cfg.TRAIN.NET_G == '':
             print('Error: the path for morels is not found!')
@@ -684,46 +944,75 @@ class condGANTrainer(object):
             save_dir = '%s/iteration%d' % (s_tmp, iteration)
 
             nz = cfg.GAN.Z_DIM
-            noise = Variable(torch.FloatTensor(self.batch_size, nz))
+            noise = torch.FloatTensor(self.batch_size, nz)
             if cfg.CUDA:
                 netG.cuda()
                 noise = noise.cuda()
 
+            log_dir = os.path.join(save_dir, 'Log')
+            mkdir_p(log_dir)
+            profiler = StepProfiler(log_dir, 'evaluate', [netG])
+            profiler.start()
+
+            # only the images that are saved are generated
+            stage = 2 if cfg.TEST.B_EXAMPLE else cfg.TREE.BRANCH_NUM - 1
+            writer = ImageWriter(cfg.TEST.WRITE_WORKERS)
+            if cfg.TEST.B_EXAMPLE:
+                folder = '%s/super/%s' % (save_dir, split_dir)
+            else:
+                folder = '%s/single_samples/%s' % (save_dir, split_dir)
+            filenames = getattr(self.data_loader.dataset, 'filenames', [])
+            writer.make_dirs(['%s/%s' % (folder, key) for key in filenames])
+
             # switch to evaluate mode
             netG.eval()
+            start_t = time.time()
             for step, data in enumerate(self.data_loader, 0):
                 imgs, t_embeddings, filenames = data
-                if cfg.CUDA:
-                    t_embeddings = Variable(t_embeddings).cuda()
-                else:
-                    t_embeddings = Variable(t_embeddings)
-                # print(t_embeddings[:, 0, :], t_embeddings.size(1))
-
-                embedding_dim = t_embeddings.size(1)
+                filenames = [str(key) for key in filenames]
                 batch_size = imgs[0].size(0)
-                noise.data.resize_(batch_size, nz)
-                noise.data.normal_(0, 1)
-
-                fake_img_list = []
-                for i in range(embedding_dim):
-                    #fake_imgs, _, _ = netG(noise, t_embeddings[:, i, :])
-                    fake_imgs= netG(noise, t_embeddings[:, i, :])
-                    if cfg.TEST.B_EXAMPLE:
-                        # fake_img_list.append(fake_imgs[0].data.cpu())
-                        # fake_img_list.append(fake_imgs[1].data.cpu())
-                        fake_img_list.append(fake_imgs[2].data.cpu())
-                    else:
-                        self.save_singleimages(fake_imgs[-1], filenames,
-                                               save_dir, split_dir, i, 256)
-                        # self.save_singleimages(fake_imgs[-2], filenames,
-                        #                        save_dir, split_dir, i, 128)
-                        # self.save_singleimages(fake_imgs[-3], filenames,
-                        #                        save_dir, split_dir, i, 64)
-                    # break
+                # all embeddings of a batch run as one G batch of
+                # batch_size * embedding_dim; the embeddings of an image
+                # share its noise vector
+                if t_embeddings.dim() == 3:
+                    embedding_dim = t_embeddings.size(1)
+                    c_code = t_embeddings.view(
+                        batch_size * embedding_dim, -1).float()
+                    if cfg.CUDA:
+                        c_code = c_code.cuda()
+                else:
+                    # no per-sample embeddings: G_NET1 conditions on z
+                    embedding_dim, c_code = 1, None
+                noise.resize_(batch_size, nz).normal_(0, 1)
+                z_code = noise.repeat_interleave(embedding_dim, 0)
+                with torch.no_grad():
+                    fake_imgs = netG(z_code, c_code, out_stages=[stage])
+                fake_imgs = fake_imgs[stage]
+                imsize = fake_imgs.size(-1)
+
+                paths = ['%s/%s' % (folder, key) for key in filenames]
+                writer.make_dirs(paths)
                 if cfg.TEST.B_EXAMPLE:
-                    # self.save_superimages(fake_img_list, filenames,
-                    #                       save_dir, split_dir, 64)
-                    # self.save_superimages(fake_img_list, filenames,
-                    #                       save_dir, split_dir, 128)
-                    self.save_superimages(fake_img_list, filenames,
-                                          save_dir, split_dir, 256)
+                    grids = [vutils.make_grid(
+                        fake_imgs[i * embedding_dim:(i + 1) * embedding_dim],
+                        nrow=10, normalize=True) for i in range(batch_size)]
+                    # rounded like vutils.save_image
+                    grids = torch.stack(grids).mul(255).add_(0.5).clamp(0, 255)
+                    ndarrs = grids.byte().permute(0, 2, 3, 1).cpu().numpy()
+                    for i in range(batch_size):
+                        writer.write(ndarrs[i],
+                                     '%s_%d.png' % (paths[i], imsize))
+                else:
+                    # range from [-1, 1] to [0, 255]
+                    pixels = fake_imgs.add(1).div(2).mul(255).clamp(0, 255)
+                    ndarrs = pixels.byte().permute(0, 2, 3, 1).cpu().numpy()
+                    for k in range(ndarrs.shape[0]):
+                        i, sentence = divmod(k, embedding_dim)
+                        writer.write(ndarrs[k], '%s_%d_sentence%d.png' %
+                                     (paths[i], imsize, sentence))
+                profiler.step()
+            profiler.stop()
+            writer.close()
+            elapsed = time.time() - start_t
+            print('Wrote %d images in %.1f sec (%.1f img/s)' %
+                  (writer.count, elapsed, writer.count / max(elapsed, 1e-6)))